@@ -1,210 +1,373 @@
 #!/usr/bin/env python3
 
-import ast
+import math
 import os
-import base64
-from typing import List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 
-import boto3
-from botocore.exceptions import ClientError
 import requests
 from psycopg2 import sql
 from flask_cors import CORS, cross_origin
 from flask import Flask, jsonify, request, Response
 
-from use_postgres import UseDatabase
+from credentials import (AURORA_SECRET, GROW_API_SECRET, WOW_API_SECRET,
+                        aurora_creds_from_secret, get_secrets, prefetch_secrets)
+from response_cache import DataVersion, ResponseCache, SingleFlight, VersionedValue
+from downsample import lttb_aligned
+from json_response import columnar_json_bytes, compress_response, json_agg_bytes, stream_json_array
+from live_updates import UpdateBroadcaster, event_stream
+from spatial_index import SensorClusters, SensorGridIndex
+from use_postgres import UseDatabase, pool_metrics
 
 application = Flask(__name__)
 app = application
 CORS(app)
+app.after_request(compress_response)
+data_version = DataVersion()
+sensor_cache = ResponseCache(data_version)
+# Seconds to cache GROW & WOW API responses. Concurrent identical
+# upstream requests share one call.
+GROW_GAP_TTL = int(os.environ.get('GROW_GAP_TTL', 300))
+WOW_TAIL_TTL = int(os.environ.get('WOW_TAIL_TTL', 300))
+grow_api_calls = SingleFlight(GROW_GAP_TTL)
+wow_api_calls = SingleFlight(WOW_TAIL_TTL)
+update_broadcaster = UpdateBroadcaster()
+prefetch_secrets(AURORA_SECRET, GROW_API_SECRET, WOW_API_SECRET)
 
 @app.before_first_request
 def before_first_request():
     """Retrieve secret credentials for AWS RDS Aurora Database,
-    GROW Thingful API & Met Office WOW API from AWS Secrets Manager.
+    GROW Thingful API & Met Office WOW API, fetched together by
+    credentials.py since the process started.
     """
-    secret_name = "grow-data-key"
-    region_name = "eu-west-1"
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    # Rethrow the exception by default.
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            # Convert string to dictionary to later access secret values
-            aurora_secret = ast.literal_eval(secret)
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-
-    # Retrieve secret credentials for GROW Thingful API
-    secret_name = "grow-api"
-    region_name = "eu-west-1"
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            raise e
-    else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            global grow_api_secret
-            grow_api_secret = ast.literal_eval(secret)
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-
-    # Retrieve secret credentials for Met Office WOW API
-    secret_name = "wow-api"
-    region_name = "eu-west-1"
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            raise e
-    else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            global wow_api_secret
-            wow_api_secret = ast.literal_eval(secret)
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-
-    global aurora_creds
-    aurora_creds = {
-            'host': aurora_secret['host'],
-            'port': aurora_secret['port'],
-            'dbname': aurora_secret['engine'],
-            'user': aurora_secret['username'],
-            'password': aurora_secret['password']
-        }
+    global aurora_creds, grow_api_secret, wow_api_secret
+    aurora_secret, grow_api_secret, wow_api_secret = get_secrets(
+        AURORA_SECRET, GROW_API_SECRET, WOW_API_SECRET)
+    aurora_creds = aurora_creds_from_secret(aurora_secret)
     return aurora_creds, grow_api_secret, wow_api_secret
 
+def sensor_feed_response(key: str, query_from: str) -> Response:
+    """Return the all_sensor_info rows matched by query_from (FROM, JOIN
+    & WHERE clauses) as a cached JSON array serialized by Postgres, or
+    with format=columnar as one array per column.
+    """
+    query_from = sql.SQL(query_from)
+    if request.args.get('format') == 'columnar':
+        def build() -> bytes:
+            with UseDatabase(aurora_creds, pooled=True) as cursor:
+                return columnar_json_bytes(cursor, 'all_sensor_info', query_from)
+        return sensor_cache.response(f'{key}:columnar', aurora_creds, build)
+    def build() -> bytes:
+        with UseDatabase(aurora_creds, pooled=True) as cursor:
+            return json_agg_bytes(cursor, sql.SQL(
+                'SELECT row_to_json(all_sensor_info) {}').format(query_from))
+    return sensor_cache.response(key, aurora_creds, build)
+
 @app.route('/api/all_grow_true_json')
 @cross_origin()
 def fetch_all_json() -> 'JSON':
     """Fetch all GROW sensor info as JSON"""
-    with UseDatabase(aurora_creds) as cursor:
-        resp_list = []
-        SQL = """SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info;"""
-        cursor.execute(SQL)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    return sensor_feed_response('all', """FROM all_sensor_info""")
 
 @app.route('/api/all_grow_healthy_json')
 @cross_origin()
 def fetch_all_healthy_json() -> 'JSON':
-    """Fetch all healthy GROW sensor info as JSON"""
-    with UseDatabase(aurora_creds) as cursor:
-        resp_list = []
-        SQL = """SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info 
-                WHERE sensor_id NOT IN 
-                    (SELECT SUBSTRING(grow_table, 11, 8) 
-					FROM grow_anomalies);"""
-        cursor.execute(SQL)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    """Fetch all healthy GROW sensor info as JSON. Sensors without a
+    sensor_health row yet (added since the last detection run) are healthy.
+    """
+    return sensor_feed_response('healthy', """FROM all_sensor_info 
+                                            LEFT JOIN sensor_health USING (sensor_id)
+                                            WHERE COALESCE(status, 'healthy') = 'healthy'""")
 
 @app.route('/api/all_grow_recovered_json')
 @cross_origin()
 def fetch_all_recovered_json() -> 'JSON':
     """Fetch all recovered GROW sensor info as JSON"""
-    with UseDatabase(aurora_creds) as cursor:
-        resp_list = []
-        SQL = """SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info 
-                WHERE sensor_id IN 
-                    (SELECT SUBSTRING(grow_table, 11, 8) 
-					FROM grow_anomalies
-				   	WHERE days_since_anomaly >= 2);"""
-        cursor.execute(SQL)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    return sensor_feed_response('recovered', """FROM all_sensor_info 
+                                                JOIN sensor_health USING (sensor_id)
+                                                WHERE status = 'recovered'""")
 
 @app.route('/api/all_grow_faulty_json')
 @cross_origin()
 def fetch_all_faulty_json() -> 'JSON':
     """Fetch all faulty GROW sensor info as JSON"""
-    with UseDatabase(aurora_creds) as cursor:
-        resp_list = []
-        SQL = """SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info 
-                WHERE sensor_id IN 
-                    (SELECT SUBSTRING(grow_table, 11, 8) 
-					FROM grow_anomalies
-				   	WHERE days_since_anomaly < 2);"""
-        cursor.execute(SQL)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    return sensor_feed_response('faulty', """FROM all_sensor_info 
+                                            JOIN sensor_health USING (sensor_id)
+                                            WHERE status = 'faulty'""")
+
+# GROW API variable codes returned by /api/indiv_grow_data and their
+# column in the local grow_data_ tables
+GROW_VARIABLES = {'Thingful.Connectors.GROWSensors.light': 'light',
+                'Thingful.Connectors.GROWSensors.air_temperature': 'air_temperature',
+                'Thingful.Connectors.GROWSensors.calibrated_soil_moisture': 'soil_moisture'}
+
+def request_grow_api(sensor_id: str, start: str, end: str) -> dict:
+    """Fetch GROW data for sensor & time interval from the GROW
+    Thingful API. Dates are formatted as 20181028200000.
+    """
+    header = grow_api_secret
+    url = 'https://grow.thingful.net/api/timeSeries/get'
+    payload = {'Readers': [{'DataSourceCode': 'Thingful.Connectors.GROWSensors',
+                            'Settings': 
+                                {'LocationCodes': [sensor_id], # 02krq5q5
+                                'VariableCodes': list(GROW_VARIABLES),
+                                'StartDate': start, # 20181028200000
+                                'EndDate': end }}]}
+    response = requests.post(url, headers=header, json=payload)
+    return response.json()
+
+def fetch_local_grow(sensor_id: str, start: datetime, end: datetime) -> Tuple[List, datetime]:
+    """Fetch GROW data for sensor & time interval already copied to
+    Aurora by extract_all_grow_data.py, most recent first. Also returns
+    the datetime of the most recent stored reading (the watermark),
+    None if the sensor has not been stored yet.
+    """
+    table_name = f'grow_data_{sensor_id}'
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT to_regclass(%s) IS NOT NULL, 
+                            (SELECT datetime
+                            FROM sensor_latest_reading
+                            WHERE sensor_id = %s)""", (table_name, sensor_id))
+        table_exists, watermark = cursor.fetchone()
+        if not table_exists or watermark is None:
+            return [], None
+        sql_select = sql.SQL("""SELECT datetime, light, air_temperature, soil_moisture
+                                FROM {}
+                                WHERE datetime BETWEEN {} AND {}
+                                ORDER BY datetime DESC""").format(sql.Identifier(table_name),
+                                                                    sql.Literal(start),
+                                                                    sql.Literal(end))
+        cursor.execute(sql_select)
+        rows = cursor.fetchall()
+    return rows, watermark
+
+def fetch_grow_gap(sensor_id: str, start: str, end: str) -> dict:
+    """Fetch GROW data newer than the local watermark from the GROW API.
+    Concurrent requests for the same sensor & interval share one
+    call, cached for GROW_GAP_TTL seconds.
+    """
+    key = (sensor_id.strip().lower(), start, end)
+    return grow_api_calls.do(key, lambda: request_grow_api(sensor_id, start, end))
+
+def fetch_wow_tail(site_id: str, start: datetime, end: datetime) -> List:
+    """Fetch WOW observations that are not stored locally from the
+    WOW API. Concurrent requests for the same site & interval share
+    one call, cached for WOW_TAIL_TTL seconds.
+    """
+    start = start.strftime('%Y-%m-%dT%H:%M:%S')
+    end = end.strftime('%Y-%m-%dT%H:%M:%S')
+    return wow_api_calls.do((site_id, start, end),
+                            lambda: request_wow_api(site_id, start, end))
+
+def grow_series(sensor_id: str, start: str, end: str) -> dict:
+    """Return GROW data for sensor & time interval in the GROW API
+    response format, served from Aurora up to the local watermark
+    and from the GROW API after it.
+    """
+    start_dt = datetime.strptime(start, '%Y%m%d%H%M%S')
+    end_dt = datetime.strptime(end, '%Y%m%d%H%M%S')
+    rows, watermark = fetch_local_grow(sensor_id, start_dt, end_dt)
+    return complete_grow_series(sensor_id, start, end, rows, watermark)
+
+def complete_grow_series(sensor_id: str, start: str, end: str,
+                        rows: List, watermark: datetime) -> dict:
+    """Add GROW API readings newer than the watermark to stored rows
+    of a sensor & time interval, in the GROW API response format.
+    """
+    start_dt = datetime.strptime(start, '%Y%m%d%H%M%S')
+    end_dt = datetime.strptime(end, '%Y%m%d%H%M%S')
+    if watermark is None or watermark < start_dt:
+        # Nothing stored for the interval, use the GROW API only
+        return fetch_grow_gap(sensor_id, start, end)
+    gap = None
+    if watermark < end_dt:
+        gap_start = (watermark + timedelta(seconds=1)).strftime('%Y%m%d%H%M%S')
+        gap = fetch_grow_gap(sensor_id, gap_start, end)
+    return merge_grow_series(rows, gap)
+
+def merge_grow_series(rows: List, gap: dict = None) -> dict:
+    """Combine GROW API readings newer than the watermark (gap) with 
+    stored (datetime, light, air_temperature, soil_moisture) rows 
+    into the GROW API response format, most recent first.
+    """
+    series = {code: [] for code in GROW_VARIABLES}
+    if gap is not None:
+        for variable in gap.get('Data', []):
+            if variable['VariableCode'] in series:
+                series[variable['VariableCode']].extend(variable['Data'])
+    for row in rows:
+        date_str = row[0].strftime('%Y%m%d%H%M%S')
+        for index, code in enumerate(GROW_VARIABLES, start=1):
+            value = float(row[index]) if row[index] is not None else None
+            series[code].append({'DateTime': date_str, 'Value': value})
+    return {'Data': [{'VariableCode': code, 'Data': data} 
+                    for code, data in series.items()]}
+
+# Series resolutions, finest first, with the time between their points
+SERIES_RESOLUTIONS = [('raw', timedelta(minutes=15)),
+                    ('hourly', timedelta(hours=1)),
+                    ('daily', timedelta(days=1))]
+# Rollup table and date_trunc field of each rollup resolution
+ROLLUP_TABLES = {'hourly': ('grow_rollup_hourly', 'hour'),
+                'daily': ('grow_rollup_daily', 'day')}
+# Points per variable returned by /api/grow_series by default & at most
+DEFAULT_POINT_BUDGET = 1000
+MAX_POINT_BUDGET = 10000
+
+def choose_resolution(start: datetime, end: datetime, points: int) -> str:
+    """Return the finest resolution whose number of points between
+    start and end fits in the point budget, else the coarsest.
+    """
+    for resolution, step in SERIES_RESOLUTIONS:
+        if (end - start) / step <= points:
+            return resolution
+    return SERIES_RESOLUTIONS[-1][0]
+
+def fetch_rollup_series(sensor_id: str, resolution: str, start: datetime, end: datetime) -> dict:
+    """Fetch hourly or daily min, mean & max of GROW data for sensor & 
+    time interval from the rollup tables kept by extract_all_grow_data.py,
+    in the GROW API response format with Value holding the mean.
+    Returns None if the sensor has no rollups.
+    """
+    table_name, field = ROLLUP_TABLES[resolution]
+    columns = sql.SQL(', ').join(
+        sql.Identifier(f'{column}_{stat}')
+        for column in GROW_VARIABLES.values() for stat in ['min', 'mean', 'max'])
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT to_regclass(%s) IS NOT NULL""", (table_name,))
+        if not cursor.fetchone()[0]:
+            return None
+        sql_select = sql.SQL("""SELECT bucket, {}
+                                FROM {}
+                                WHERE sensor_id = {}
+                                AND bucket BETWEEN date_trunc({}, {}::timestamp) AND {}
+                                ORDER BY bucket DESC""").format(
+                                    columns,
+                                    sql.Identifier(table_name),
+                                    sql.Literal(sensor_id),
+                                    sql.Literal(field),
+                                    sql.Literal(start),
+                                    sql.Literal(end))
+        cursor.execute(sql_select)
+        rows = cursor.fetchall()
+    if rows == []:
+        return None
+    series = {code: [] for code in GROW_VARIABLES}
+    for row in rows:
+        date_str = row[0].strftime('%Y%m%d%H%M%S')
+        for index, code in enumerate(GROW_VARIABLES):
+            low, mean, high = (float(x) if x is not None else None
+                                for x in row[1 + index * 3:4 + index * 3])
+            series[code].append({'DateTime': date_str, 'Value': mean,
+                                'Min': low, 'Max': high})
+    return {'Data': [{'VariableCode': code, 'Data': data}
+                    for code, data in series.items()]}
+
+def downsample_series(series: dict, points: int) -> dict:
+    """Return a copy of a GROW API format series LTTB downsampled to at
+    most points readings per variable, most recent first. Every variable
+    keeps the same datetimes, so readings stay aligned by index as the
+    charts expect. Readings missing for a kept datetime have Value None.
+    """
+    codes = [x['VariableCode'] for x in series.get('Data', [])]
+    values = defaultdict(dict)
+    for variable in series.get('Data', []):
+        for reading in variable['Data']:
+            values[reading['DateTime']][variable['VariableCode']] = reading['Value']
+    datetimes = sorted(values)
+    x = [datetime.strptime(date_str, '%Y%m%d%H%M%S').timestamp() for date_str in datetimes]
+    columns = [[values[date_str].get(code) for date_str in datetimes] for code in codes]
+    selected = [datetimes[i] for i in reversed(lttb_aligned(x, columns, points))]
+    return {'Data': [{'VariableCode': code,
+                    'Data': [{'DateTime': date_str, 'Value': values[date_str].get(code)}
+                            for date_str in selected]}
+                    for code in codes]}
+
+def fetch_sensors_with_status() -> List[dict]:
+    """Fetch all GROW sensor info with each sensor's health status"""
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT row_to_json(all_sensor_info), 
+                        COALESCE(status, 'healthy')
+                        FROM all_sensor_info
+                        LEFT JOIN sensor_health USING (sensor_id);""")
+        return [dict(x[0], status=x[1]) for x in cursor.fetchall()]
+
+def build_sensor_index() -> SensorGridIndex:
+    """Build grid index over all GROW sensors and their health status"""
+    return SensorGridIndex(fetch_sensors_with_status())
+
+def build_sensor_clusters() -> Dict[str, SensorClusters]:
+    """Build clusters of all GROW sensors, and of the sensors of each
+    status, for every map zoom level
+    """
+    sensors = fetch_sensors_with_status()
+    clusters = {status: SensorClusters([x for x in sensors if x['status'] == status])
+                for status in ['healthy', 'recovered', 'faulty']}
+    clusters['all'] = SensorClusters(sensors)
+    return clusters
+
+sensor_index = VersionedValue(data_version, build_sensor_index)
+sensor_clusters = VersionedValue(data_version, build_sensor_clusters)
+
+@app.route('/api/sensors_in_bbox')
+@cross_origin()
+def sensors_in_bbox() -> 'JSON':
+    """Fetch GROW sensor info of sensors inside a lat/lon box,
+    optionally filtered by status (healthy, recovered or faulty)
+    """
+    try:
+        min_lat = float(request.args['min_lat'])
+        min_lon = float(request.args['min_lon'])
+        max_lat = float(request.args['max_lat'])
+        max_lon = float(request.args['max_lon'])
+    except (KeyError, ValueError):
+        return jsonify(error='min_lat, min_lon, max_lat & max_lon are required numbers'), 400
+    if not all(math.isfinite(x) for x in [min_lat, min_lon, max_lat, max_lon]):
+        return jsonify(error='min_lat, min_lon, max_lat & max_lon must be finite'), 400
+    status = request.args.get('status', None)
+    sensors = sensor_index.get(aurora_creds).query(min_lat, min_lon, max_lat, max_lon, status)
+    return jsonify(sensors)
+
+@app.route('/api/sensor_clusters')
+@cross_origin()
+def sensor_clusters_at_zoom() -> 'JSON':
+    """Fetch GROW sensor clusters for a map zoom level, optionally
+    inside a lat/lon box and only of sensors with a status (healthy,
+    recovered or faulty). Each cluster has its sensor count by status,
+    centroid and the bounding box to zoom into to expand it. Clusters
+    of one sensor also hold that sensor's info.
+    """
+    try:
+        zoom = int(request.args['zoom'])
+        min_lat = float(request.args.get('min_lat', -90))
+        min_lon = float(request.args.get('min_lon', -180))
+        max_lat = float(request.args.get('max_lat', 90))
+        max_lon = float(request.args.get('max_lon', 180))
+    except (KeyError, ValueError):
+        return jsonify(error='zoom is a required integer, min_lat, min_lon, max_lat & max_lon are numbers'), 400
+    if not all(math.isfinite(x) for x in [min_lat, min_lon, max_lat, max_lon]):
+        return jsonify(error='min_lat, min_lon, max_lat & max_lon must be finite'), 400
+    clusters = sensor_clusters.get(aurora_creds).get(request.args.get('status', 'all'))
+    if clusters is None:
+        return jsonify(error='status is healthy, recovered or faulty'), 400
+    return jsonify(clusters.query(zoom, min_lat, min_lon, max_lat, max_lon))
+
+@app.route('/api/updates')
+@cross_origin()
+def stream_updates() -> Response:
+    """Stream sensor status changes & new latest readings as server-sent
+    events, as the ETL scripts commit them. Each event's data is a JSON
+    object with a 'type' of 'status' or 'latest_reading' and a sensor_id.
+    Every open stream holds one worker thread, the async serving mode
+    (asgi.py) serves this route without one.
+    """
+    response = Response(event_stream(update_broadcaster, aurora_creds),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/indiv_grow_data')
 @cross_origin()
@@ -215,35 +378,151 @@ def get_me_grow() -> 'JSON':
     end = request.args.get('end', None)
     end = end.replace('-','').replace('T','').replace(':','')
     sensor_id = request.args.get('sensor_id', None)
-    header = grow_api_secret
-    url = 'https://grow.thingful.net/api/timeSeries/get'
-    payload = {'Readers': [{'DataSourceCode': 'Thingful.Connectors.GROWSensors',
-                            'Settings': 
-                                {'LocationCodes': [sensor_id], # 02krq5q5
-                                'VariableCodes': ['Thingful.Connectors.GROWSensors.light',
-                                                'Thingful.Connectors.GROWSensors.air_temperature',
-                                                'Thingful.Connectors.GROWSensors.calibrated_soil_moisture'],
-                                'StartDate': start, # 20181028200000
-                                'EndDate': end }}]}
-    response = requests.post(url, headers=header, json=payload)
-    return response.content
+    return jsonify(grow_series(sensor_id, start, end))
+
+@app.route('/api/grow_series')
+@cross_origin()
+def get_grow_series() -> 'JSON':
+    """Fetch GROW data for specified sensor & time interval at the finest
+    resolution (raw, hourly or daily) that fits in a point budget per
+    variable. With downsample=lttb raw data is LTTB downsampled to the
+    budget instead of being replaced by rollups. Rollups cover data
+    already stored in Aurora.
+    """
+    try:
+        start = request.args['start'].replace('-','').replace('T','').replace(':','')
+        end = request.args['end'].replace('-','').replace('T','').replace(':','')
+        sensor_id = request.args['sensor_id']
+        start_dt = datetime.strptime(start, '%Y%m%d%H%M%S')
+        end_dt = datetime.strptime(end, '%Y%m%d%H%M%S')
+        points = int(request.args.get('points', DEFAULT_POINT_BUDGET))
+    except (KeyError, ValueError):
+        return jsonify(error='sensor_id, start & end are required, points is an integer'), 400
+    points = max(3, min(points, MAX_POINT_BUDGET))
+    resolution = choose_resolution(start_dt, end_dt, points)
+    series = None
+    if resolution != 'raw' and request.args.get('downsample') != 'lttb':
+        series = fetch_rollup_series(sensor_id, resolution, start_dt, end_dt)
+    if series is None:
+        resolution = 'raw'
+        series = downsample_series(grow_series(sensor_id, start, end), points)
+    series['Resolution'] = resolution
+    return jsonify(series)
 
 @app.route('/api/check_faulty_grow')
 @cross_origin()
 def check_faulty_grow() -> List:
     """Fetch most recent anomaly date for specific GROW sensor"""
     sensor_id = request.args.get('sensor_id', None)
-    grow_table = f'grow_data_{sensor_id}'
-    with UseDatabase(aurora_creds) as cursor:
-        sql_select = sql.SQL("""SELECT days_since_anomaly, 
-                                MAX(GREATEST(soil_date, light_date, air_date))
-                                FROM grow_anomalies
-                                WHERE grow_table = {}
-                                GROUP BY days_since_anomaly;""").format(sql.Literal(grow_table))
-        cursor.execute(sql_select)
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT days_since_anomaly, last_anomaly
+                        FROM sensor_health
+                        WHERE sensor_id = %s
+                        AND last_anomaly IS NOT NULL;""", (sensor_id,))
         response = cursor.fetchall()
     return jsonify(response)
 
+def request_wow_api(site_id: str, start: str, end: str) -> List:
+    """Fetch observations of a WOW site & time interval from the 
+    Met Office WOW API. Dates are formatted as 2019-05-24T20:00:00.
+    """
+    header = wow_api_secret
+    url = 'https://apimgmt.www.wow.metoffice.gov.uk/api/observations/byversion'
+    payload = {'site_id': site_id,
+            'start_time': start, # 2019-05-24T20:00:00
+            'end_time': end}
+    response = requests.get(url, headers=header, params=payload)
+    # Raise on error responses so they are not cached as observations
+    response.raise_for_status()
+    json_object = response.json()
+    return [(i['ReportEndDateTime'], i['DryBulbTemperature_Celsius'], 
+            i['RainfallAmount_Millimetre']) for i in json_object['Object']]
+
+# Stored WOW observations are only used once extract_wow_data.py
+# records how far back each site was backfilled
+SQL_WOW_STORE_EXISTS = """SELECT EXISTS (SELECT 1
+                            FROM information_schema.columns
+                            WHERE table_name = 'wow_watermarks'
+                            AND column_name = 'backfilled_from')"""
+
+def fetch_local_wow(site_id: str, start: str, end: str) -> Tuple[List, datetime, datetime]:
+    """Fetch observations of a WOW site & time interval already copied
+    to Aurora by extract_wow_data.py, most recent first. Also returns
+    the datetimes of the most recent stored observation (the watermark)
+    and of the start of the backfill, None if the site has not been
+    stored yet.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute(SQL_WOW_STORE_EXISTS)
+        if not cursor.fetchone()[0]:
+            return [], None, None
+        cursor.execute("""SELECT last_datetime, backfilled_from
+                        FROM wow_watermarks
+                        WHERE site_id = %s""", (site_id,))
+        stored = cursor.fetchone()
+        if stored is None:
+            return [], None, None
+        cursor.execute("""SELECT datetime, air_temp, rainfall
+                        FROM wow_observations
+                        WHERE site_id = %s
+                        AND datetime BETWEEN %s AND %s
+                        ORDER BY datetime DESC""", (site_id, start, end))
+        rows = [(x[0].strftime('%Y-%m-%dT%H:%M:%S'),
+                float(x[1]) if x[1] is not None else None,
+                float(x[2]) if x[2] is not None else None) for x in cursor.fetchall()]
+    return rows, stored[0], stored[1]
+
+def wow_series(site_id: str, distance: float, start: str, end: str) -> dict:
+    """Return observations of a WOW site & time interval, served from
+    Aurora between the backfill start and the local watermark and
+    from the WOW API outside it.
+    """
+    rows, watermark, backfilled_from = fetch_local_wow(site_id, start, end)
+    return complete_wow_series(site_id, distance, start, end, rows, watermark,
+                                backfilled_from)
+
+def wow_api_intervals(start_dt: datetime, end_dt: datetime, watermark: datetime,
+                    backfilled_from: datetime) -> Tuple[Optional[Tuple], Optional[Tuple]]:
+    """Return the (start, end) parts of a time interval newer and older
+    than the observations stored from backfilled_from to the watermark,
+    None where the interval is stored.
+    """
+    if (watermark is None or backfilled_from is None
+            or watermark < start_dt or backfilled_from > end_dt):
+        return (start_dt, end_dt), None
+    newer = None
+    older = None
+    if watermark < end_dt:
+        newer = (watermark + timedelta(seconds=1), end_dt)
+    if backfilled_from > start_dt:
+        older = (start_dt, backfilled_from - timedelta(seconds=1))
+    return newer, older
+
+def complete_wow_series(site_id: str, distance: float, start: str, end: str,
+                        rows: List, watermark: datetime, backfilled_from: datetime) -> dict:
+    """Add WOW API observations newer than the watermark and older than
+    the backfill to stored observations of a WOW site & time interval.
+    """
+    start_dt = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S')
+    end_dt = datetime.strptime(end, '%Y-%m-%dT%H:%M:%S')
+    newer, older = wow_api_intervals(start_dt, end_dt, watermark, backfilled_from)
+    if newer is not None:
+        rows = fetch_wow_tail(site_id, *newer) + rows
+    if older is not None:
+        rows = rows + fetch_wow_tail(site_id, *older)
+    return wow_response(rows, distance)
+
+def wow_response(rows: List, distance: float) -> dict:
+    """Convert (datetime, air_temp, rainfall) WOW observations to
+    the /api/get_wow_data response format
+    """
+    data_dict = dict()
+    data_dict['distance'] = [float(distance)]
+    data_dict['datetime'] = [x[0] for x in rows]
+    data_dict['air_temp'] = [x[1] for x in rows]
+    data_dict['rainfall'] = [x[2] for x in rows]
+    return data_dict
+
 @app.route('/api/get_wow_data')
 @cross_origin()
 def get_me_wow() -> 'JSON':
@@ -253,215 +532,244 @@ def get_me_wow() -> 'JSON':
     sensor_id = request.args.get('sensor_id', None)
     start = request.args.get('start', None)
     end = request.args.get('end', None)
-    wow_site_id, distance = match_wow_site(sensor_id)
-    header = wow_api_secret
-    url = 'https://apimgmt.www.wow.metoffice.gov.uk/api/observations/byversion'
-    payload = {'site_id': wow_site_id,
-            'start_time': start, # 2019-05-24T20:00:00
-            'end_time': end}
-    response = requests.get(url, headers=header, params=payload)
-    json_object = response.json()
-    data_dict = dict()
-    data_dict['distance'] = []
-    data_dict['datetime'] = []
-    data_dict['air_temp'] = []
-    data_dict['rainfall'] = []
-    for i in json_object['Object']:
-        data_dict['air_temp'].append(i['DryBulbTemperature_Celsius'])
-        data_dict['rainfall'].append(i['RainfallAmount_Millimetre'])
-        data_dict['datetime'].append(i['ReportEndDateTime'])
-    data_dict['distance'].append(float(distance))
-    return jsonify(data_dict)
+    wow_site = match_wow_site(sensor_id)
+    if wow_site is None:
+        return jsonify(error='sensor has no nearest WOW site'), 404
+    wow_site_id, distance = wow_site
+    return jsonify(wow_series(wow_site_id, distance, start, end))
 
 def match_wow_site(sensor_id: str) -> str:
     """Find closest WOW site to select grow sensor"""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         cursor.execute("""SELECT site_id, distance
                             FROM grow_to_wow_mapping
                             WHERE sensor_id = %s;""", (sensor_id,))
         site_id = cursor.fetchone() 
     return site_id 
 
+# Sensors fetched by one /api/sensor_batch request at most
+MAX_BATCH_SENSORS = 50
+# Concurrent GROW & WOW API calls per /api/sensor_batch request
+BATCH_UPSTREAM_WORKERS = 8
+
+def fetch_local_grow_batch(sensor_ids: List[str], start: datetime, end: datetime) -> dict:
+    """Batch version of fetch_local_grow. Returns {sensor_id: (rows, 
+    watermark)} for every sensor, fetched in two queries.
+    """
+    local = {sensor_id: ([], None) for sensor_id in sensor_ids}
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT ids.sensor_id, l.datetime
+                        FROM unnest(%s::text[]) AS ids(sensor_id)
+                        JOIN sensor_latest_reading l USING (sensor_id)
+                        WHERE to_regclass('grow_data_' || ids.sensor_id) IS NOT NULL""",
+                        (sensor_ids,))
+        watermarks = dict(cursor.fetchall())
+        if watermarks == {}:
+            return local
+        sql_select = sql.SQL(' UNION ALL ').join(
+            sql.SQL("""SELECT {}, datetime, light, air_temperature, soil_moisture
+                    FROM {}
+                    WHERE datetime BETWEEN {} AND {}""").format(
+                        sql.Literal(sensor_id),
+                        sql.Identifier(f'grow_data_{sensor_id}'),
+                        sql.Literal(start),
+                        sql.Literal(end))
+            for sensor_id in watermarks)
+        cursor.execute(sql.SQL('{} ORDER BY 1, 2 DESC').format(sql_select))
+        rows = defaultdict(list)
+        for row in cursor.fetchall():
+            rows[row[0]].append(row[1:])
+    for sensor_id, watermark in watermarks.items():
+        local[sensor_id] = (rows[sensor_id], watermark)
+    return local
+
+def fetch_local_wow_batch(site_ids: List[str], start: str, end: str) -> dict:
+    """Batch version of fetch_local_wow. Returns {site_id: (rows,
+    watermark, backfilled_from)} for every WOW site, fetched in two queries.
+    """
+    local = {site_id: ([], None, None) for site_id in site_ids}
+    if site_ids == []:
+        return local
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute(SQL_WOW_STORE_EXISTS)
+        if not cursor.fetchone()[0]:
+            return local
+        cursor.execute("""SELECT site_id, last_datetime, backfilled_from
+                        FROM wow_watermarks
+                        WHERE site_id = ANY(%s)""", (site_ids,))
+        watermarks = {x[0]: x[1:] for x in cursor.fetchall()}
+        if watermarks == {}:
+            return local
+        cursor.execute("""SELECT site_id, datetime, air_temp, rainfall
+                        FROM wow_observations
+                        WHERE site_id = ANY(%s)
+                        AND datetime BETWEEN %s AND %s
+                        ORDER BY site_id, datetime DESC""", (list(watermarks), start, end))
+        rows = defaultdict(list)
+        for x in cursor.fetchall():
+            rows[x[0]].append((x[1].strftime('%Y-%m-%dT%H:%M:%S'),
+                                float(x[2]) if x[2] is not None else None,
+                                float(x[3]) if x[3] is not None else None))
+    for site_id, (watermark, backfilled_from) in watermarks.items():
+        local[site_id] = (rows[site_id], watermark, backfilled_from)
+    return local
+
+@app.route('/api/sensor_batch')
+@cross_origin()
+def get_sensor_batch() -> 'JSON':
+    """Fetch GROW data, fault status & nearest WOW site data of several
+    GROW sensors over one time interval. Takes comma separated sensor_ids
+    and returns {sensor_id: {'grow': ..., 'faults': ..., 'wow': ...}} in
+    the formats of /api/indiv_grow_data, /api/check_faulty_grow and
+    /api/get_wow_data. Stored data is read with one query per table,
+    GROW & WOW API calls for newer data are made concurrently.
+    """
+    try:
+        sensor_ids = list(dict.fromkeys(
+            x.strip() for x in request.args['sensor_ids'].split(',') if x.strip()))
+        start_dt = datetime.strptime(request.args['start'], '%Y-%m-%dT%H:%M:%S')
+        end_dt = datetime.strptime(request.args['end'], '%Y-%m-%dT%H:%M:%S')
+    except (KeyError, ValueError):
+        return jsonify(error='sensor_ids, start & end (2019-05-24T20:00:00) are required'), 400
+    if not 0 < len(sensor_ids) <= MAX_BATCH_SENSORS:
+        return jsonify(error=f'between 1 and {MAX_BATCH_SENSORS} sensor_ids are required'), 400
+    # Sensor ids are 8 alphanumeric characters, they name grow_data_ tables
+    if not all(x.isalnum() for x in sensor_ids):
+        return jsonify(error='sensor_ids must be alphanumeric'), 400
+    grow_start = start_dt.strftime('%Y%m%d%H%M%S')
+    grow_end = end_dt.strftime('%Y%m%d%H%M%S')
+    wow_start = start_dt.strftime('%Y-%m-%dT%H:%M:%S')
+    wow_end = end_dt.strftime('%Y-%m-%dT%H:%M:%S')
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT sensor_id, days_since_anomaly, last_anomaly
+                        FROM sensor_health
+                        WHERE sensor_id = ANY(%s)
+                        AND last_anomaly IS NOT NULL;""", (sensor_ids,))
+        faults = {x[0]: [list(x[1:])] for x in cursor.fetchall()}
+        cursor.execute("""SELECT sensor_id, site_id, distance
+                        FROM grow_to_wow_mapping
+                        WHERE sensor_id = ANY(%s);""", (sensor_ids,))
+        wow_sites = {x[0]: x[1:] for x in cursor.fetchall()}
+    local_grow = fetch_local_grow_batch(sensor_ids, start_dt, end_dt)
+    local_wow = fetch_local_wow_batch(list({x[0] for x in wow_sites.values()}),
+                                    wow_start, wow_end)
+    with ThreadPoolExecutor(max_workers=BATCH_UPSTREAM_WORKERS) as executor:
+        grow = {sensor_id: executor.submit(complete_grow_series, sensor_id, grow_start,
+                                            grow_end, *local_grow[sensor_id])
+                for sensor_id in sensor_ids}
+        wow = {sensor_id: executor.submit(complete_wow_series, site_id, distance, wow_start,
+                                            wow_end, *local_wow[site_id])
+                for sensor_id, (site_id, distance) in wow_sites.items()}
+        batch = {sensor_id: {'grow': grow[sensor_id].result(),
+                            'faults': faults.get(sensor_id, []),
+                            'wow': wow[sensor_id].result() if sensor_id in wow else None}
+                for sensor_id in sensor_ids}
+    return jsonify(batch)
+
 @app.route('/grow_by_address')
 def grow_by_address() -> 'JSON':
     """Fetch all sensor info by address"""
-    with UseDatabase(aurora_creds) as cursor:
-        address = request.args.get('address')
-        resp_list = []
-        sql_select = sql.SQL("""SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info
-                WHERE address = {};""").format(sql.Literal(address))
-        cursor.execute(sql_select)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    address = request.args.get('address')
+    sql_select = sql.SQL("""SELECT row_to_json(all_sensor_info)
+            FROM all_sensor_info
+            WHERE address = {}""").format(sql.Literal(address))
+    return stream_json_array(aurora_creds, sql_select)
 
 @app.route('/grow_by_owner')
 def grow_by_owner() -> 'JSON':
     """Fetch all sensor info by owner"""
-    with UseDatabase(aurora_creds) as cursor:
-        owner = request.args.get('owner_id')
-        resp_list = []
-        sql_select = sql.SQL("""SELECT row_to_json(all_sensor_info)
-                FROM all_sensor_info
-                WHERE owner_id = {};""").format(sql.Literal(owner))
-        cursor.execute(sql_select)
-        response = cursor.fetchall()
-        for i in response:
-            resp_list.append(i[0])
-    return jsonify(resp_list)
+    owner = request.args.get('owner_id')
+    sql_select = sql.SQL("""SELECT row_to_json(all_sensor_info)
+            FROM all_sensor_info
+            WHERE owner_id = {}""").format(sql.Literal(owner))
+    return stream_json_array(aurora_creds, sql_select)
 
 @app.route('/owner_stats')
 def owner_stats() -> 'DataTable':
     """Return count of healthy, recovered, & faulty GROW sensors
     per GROW owner.
     """
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         owner = request.args.get('owner_id')
-        sql_healthy = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id NOT IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_healthy)
-        healthy_sensors = [x[0] for x in cursor.fetchall()]
-        sql_recovered = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies
-				   	            WHERE days_since_anomaly >= 2)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_recovered)
-        recovered_sensors = [x[0] for x in cursor.fetchall()]
-        sql_faulty = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies
-				   	            WHERE days_since_anomaly < 2)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_faulty)
-        faulty_sensors= [x[0] for x in cursor.fetchall()]
-        sensor_dict = dict()
-        sensor_dict['owner_id'] = owner
-        sensor_dict['healthy'] = healthy_sensors
-        sensor_dict['recovered'] = recovered_sensors
-        sensor_dict['faulty'] = faulty_sensors
-        print(jsonify(sensor_dict))
+        cursor.execute("""SELECT s.sensor_id, COALESCE(h.status, 'healthy')
+                        FROM all_sensor_info s
+                        LEFT JOIN sensor_health h USING (sensor_id)
+                        WHERE s.owner_id = %s;""", (owner,))
+        sensor_status = cursor.fetchall()
+    sensor_dict = dict()
+    sensor_dict['owner_id'] = owner
+    for status in ['healthy', 'recovered', 'faulty']:
+        sensor_dict[status] = [x[0] for x in sensor_status if x[1] == status]
     return jsonify(sensor_dict)
 
+def fetch_latest_readings(owner: str, status: str) -> List:
+    """Return the most recent reading of every GROW sensor of an owner
+    with the given status, one single-row list per sensor.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        cursor.execute("""SELECT r.sensor_id, 
+                        r.battery_level, 
+                        r.soil_moisture, 
+                        r.light, 
+                        r.air_temperature, 
+                        r.datetime
+                        FROM all_sensor_info s
+                        LEFT JOIN sensor_health h USING (sensor_id)
+                        JOIN sensor_latest_reading r USING (sensor_id)
+                        WHERE s.owner_id = %s
+                        AND COALESCE(h.status, 'healthy') = %s;""", (owner, status))
+        return [[row] for row in cursor.fetchall()]
+
 @app.route('/healthy_stats')
 def healthy_stats() -> 'JSON':
     """Return most recent healthy GROW data"""
-    with UseDatabase(aurora_creds) as cursor:
-        owner = request.args.get('owner_id')
-        sql_healthy = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id NOT IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_healthy)
-        healthy_sensors = [x[0] for x in cursor.fetchall()]
-        healthy_data = []
-        for i in healthy_sensors:
-            sql_select = sql.SQL("""SELECT sensor_id, 
-                                    battery_level, 
-                                    soil_moisture, 
-                                    light, 
-                                    air_temperature, 
-                                    datetime
-                                    FROM {}
-                                    WHERE datetime = (SELECT MAX(datetime)
-                                        FROM {})""").format(sql.Identifier(f'grow_data_{i}'),
-                                        sql.Identifier(f'grow_data_{i}'))
-            cursor.execute(sql_select)
-            results = cursor.fetchall()
-            healthy_data.append(results)
-    return jsonify(healthy_data)
+    owner = request.args.get('owner_id')
+    return jsonify(fetch_latest_readings(owner, 'healthy'))
 
 @app.route('/recovered_stats')
 def recovered_stats() -> 'JSON':
     """Return most recent recovered GROW data"""
-    with UseDatabase(aurora_creds) as cursor:
-        owner = request.args.get('owner_id')
-        sql_recovered = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies
-				   	            WHERE days_since_anomaly >= 2)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_recovered)
-        recovered_sensors = [x[0] for x in cursor.fetchall()]
-        recovered_data = []
-        for i in recovered_sensors:
-            sql_select = sql.SQL("""SELECT sensor_id, 
-                                    battery_level, 
-                                    soil_moisture, 
-                                    light, 
-                                    air_temperature, 
-                                    datetime
-                                    FROM {}
-                                    WHERE datetime = (SELECT MAX(datetime)
-                                        FROM {})""").format(sql.Identifier(f'grow_data_{i}'),
-                                        sql.Identifier(f'grow_data_{i}'))
-            cursor.execute(sql_select)
-            results = cursor.fetchall()
-            recovered_data.append(results)
-    return jsonify(recovered_data)
+    owner = request.args.get('owner_id')
+    return jsonify(fetch_latest_readings(owner, 'recovered'))
 
 @app.route('/faulty_stats')
 def faulty_stats() -> 'JSON':
     """Return most recent faulty GROW data"""
-    with UseDatabase(aurora_creds) as cursor:
+    owner = request.args.get('owner_id')
+    return jsonify(fetch_latest_readings(owner, 'faulty'))
+
+@app.route('/owner_dashboard')
+def owner_dashboard() -> 'JSON':
+    """Return the healthy, recovered & faulty GROW sensors of an owner
+    and their most recent data in one response. Combines 
+    /owner_stats, /healthy_stats, /recovered_stats & /faulty_stats.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         owner = request.args.get('owner_id')
-        sql_faulty = sql.SQL("""SELECT sensor_id
-                            FROM all_sensor_info 
-                            WHERE sensor_id IN 
-                                (SELECT SUBSTRING(grow_table, 11, 8) 
-					            FROM grow_anomalies
-				   	            WHERE days_since_anomaly < 2)
-                            AND sensor_id IN
-                                (SELECT sensor_id
-                                FROM all_sensor_info
-                                WHERE owner_id = {});""").format(sql.Literal(owner))
-        cursor.execute(sql_faulty)
-        faulty_sensors = [x[0] for x in cursor.fetchall()]
-        faulty_data = []
-        for i in faulty_sensors:
-            sql_select = sql.SQL("""SELECT sensor_id, 
-                                    battery_level, 
-                                    soil_moisture, 
-                                    light, 
-                                    air_temperature, 
-                                    datetime
-                                    FROM {}
-                                    WHERE datetime = (SELECT MAX(datetime)
-                                        FROM {})""").format(sql.Identifier(f'grow_data_{i}'),
-                                        sql.Identifier(f'grow_data_{i}'))
-            cursor.execute(sql_select)
-            results = cursor.fetchall()
-            faulty_data.append(results)
-    return jsonify(faulty_data)
+        cursor.execute("""SELECT COALESCE(h.status, 'healthy'),
+                        s.sensor_id, 
+                        r.battery_level, 
+                        r.soil_moisture, 
+                        r.light, 
+                        r.air_temperature, 
+                        r.datetime
+                        FROM all_sensor_info s
+                        LEFT JOIN sensor_health h USING (sensor_id)
+                        LEFT JOIN sensor_latest_reading r USING (sensor_id)
+                        WHERE s.owner_id = %s;""", (owner,))
+        response = cursor.fetchall()
+    dashboard = dict()
+    dashboard['owner_id'] = owner
+    for status in ['healthy', 'recovered', 'faulty']:
+        dashboard[status] = [x[1] for x in response if x[0] == status]
+        dashboard[f'{status}_data'] = [[x[1:]] for x in response 
+                                        if x[0] == status and x[6] is not None]
+    return jsonify(dashboard)
+
+@app.route('/api/db_pool_metrics')
+def db_pool_metrics() -> 'JSON':
+    """Return database connection pool checkout and wait-time metrics"""
+    return jsonify(pool_metrics())
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
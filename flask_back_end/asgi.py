@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Tuple
+
+import asyncpg
+import httpx
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import application as flask_app
+from application import (GROW_GAP_TTL, GROW_VARIABLES, SQL_WOW_STORE_EXISTS,
+                        WOW_TAIL_TTL, merge_grow_series, wow_api_intervals,
+                        wow_response)
+from live_updates import HEARTBEAT_SECONDS, RECONNECT_SECONDS, SUBSCRIBER_QUEUE_SIZE
+from response_cache import AsyncSingleFlight
+from use_postgres import UPDATES_CHANNEL
+
+# Async serving mode for the back end. The upstream-proxy routes
+# /api/indiv_grow_data and /api/get_wow_data, and the /api/updates
+# event stream, run on the event loop with async HTTP & Postgres
+# clients, every other route is served by the Flask app.
+# Run with: uvicorn asgi:app --workers 2
+
+# Concurrent identical upstream requests share one call, as in the Flask app
+grow_api_calls = AsyncSingleFlight(GROW_GAP_TTL)
+wow_api_calls = AsyncSingleFlight(WOW_TAIL_TTL)
+
+class AsyncUpdateBroadcaster:
+    """asyncio version of live_updates.UpdateBroadcaster. LISTENs on 
+    UPDATES_CHANNEL with one asyncpg connection and copies every
+    notification to each subscribed stream's queue, so open streams
+    hold no worker thread.
+    """
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.subscribers = set()
+        self.event_ids = itertools.count(1)
+        self.conn = None
+
+    async def listen(self) -> None:
+        """Open the listening connection, again if it was lost"""
+        async with self.lock:
+            if self.conn is None or self.conn.is_closed():
+                self.conn = await asyncpg.connect(**db_args)
+                await self.conn.add_listener(UPDATES_CHANNEL, self.publish)
+
+    async def subscribe(self) -> asyncio.Queue:
+        await self.listen()
+        subscriber = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: asyncio.Queue) -> None:
+        self.subscribers.discard(subscriber)
+
+    def publish(self, conn, pid: int, channel: str, payload: str) -> None:
+        event = (next(self.event_ids), payload)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except asyncio.QueueFull:
+                # Close the slow client's stream, it reloads on reconnect
+                self.unsubscribe(subscriber)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(None)
+
+    async def close(self) -> None:
+        if self.conn is not None:
+            await self.conn.close()
+
+async def startup() -> None:
+    """Load secrets through the Flask app, then open the async clients"""
+    global aurora_creds, grow_api_secret, wow_api_secret, db_args, db_pool
+    global http_client, update_broadcaster
+    aurora_creds, grow_api_secret, wow_api_secret = \
+        await run_in_threadpool(flask_app.before_first_request)
+    db_args = {'host': aurora_creds['host'],
+                'port': aurora_creds['port'],
+                'database': aurora_creds['dbname'],
+                'user': aurora_creds['user'],
+                'password': aurora_creds['password']}
+    db_pool = await asyncpg.create_pool(**db_args, min_size=1, max_size=10)
+    http_client = httpx.AsyncClient(timeout=60)
+    update_broadcaster = AsyncUpdateBroadcaster()
+
+async def shutdown() -> None:
+    await http_client.aclose()
+    await db_pool.close()
+    await update_broadcaster.close()
+
+async def fetch_local_grow(sensor_id: str, start: datetime, end: datetime) -> Tuple[List, datetime]:
+    """Async version of application.fetch_local_grow"""
+    table_name = f'grow_data_{sensor_id}'
+    async with db_pool.acquire() as conn:
+        table_exists, watermark = await conn.fetchrow(
+            """SELECT to_regclass($1) IS NOT NULL,
+                (SELECT datetime
+                FROM sensor_latest_reading
+                WHERE sensor_id = $2)""", table_name, sensor_id)
+        if not table_exists or watermark is None:
+            return [], None
+        # asyncpg has no identifier quoting helper, sensor ids are
+        # 8 alphanumeric characters
+        if not sensor_id.isalnum():
+            return [], None
+        rows = await conn.fetch(
+            f"""SELECT datetime, light, air_temperature, soil_moisture
+                FROM "{table_name}"
+                WHERE datetime BETWEEN $1 AND $2
+                ORDER BY datetime DESC""", start, end)
+    return rows, watermark
+
+async def request_grow_api(sensor_id: str, start: str, end: str) -> dict:
+    """Async version of application.request_grow_api"""
+    url = 'https://grow.thingful.net/api/timeSeries/get'
+    payload = {'Readers': [{'DataSourceCode': 'Thingful.Connectors.GROWSensors',
+                            'Settings':
+                                {'LocationCodes': [sensor_id],
+                                'VariableCodes': list(GROW_VARIABLES),
+                                'StartDate': start,
+                                'EndDate': end }}]}
+    response = await http_client.post(url, headers=grow_api_secret, json=payload)
+    return response.json()
+
+async def fetch_grow_gap(sensor_id: str, start: str, end: str) -> dict:
+    """Async version of application.fetch_grow_gap"""
+    key = (sensor_id.strip().lower(), start, end)
+    return await grow_api_calls.do(key, lambda: request_grow_api(sensor_id, start, end))
+
+async def get_me_grow(request) -> JSONResponse:
+    """Fetch GROW data for specified sensor & time interval"""
+    start = request.query_params['start'].replace('-','').replace('T','').replace(':','')
+    end = request.query_params['end'].replace('-','').replace('T','').replace(':','')
+    sensor_id = request.query_params['sensor_id']
+    start_dt = datetime.strptime(start, '%Y%m%d%H%M%S')
+    end_dt = datetime.strptime(end, '%Y%m%d%H%M%S')
+    rows, watermark = await fetch_local_grow(sensor_id, start_dt, end_dt)
+    if watermark is None or watermark < start_dt:
+        return JSONResponse(await fetch_grow_gap(sensor_id, start, end))
+    gap = None
+    if watermark < end_dt:
+        gap_start = (watermark + timedelta(seconds=1)).strftime('%Y%m%d%H%M%S')
+        gap = await fetch_grow_gap(sensor_id, gap_start, end)
+    return JSONResponse(merge_grow_series(rows, gap))
+
+async def request_wow_api(site_id: str, start: str, end: str) -> List:
+    """Async version of application.request_wow_api"""
+    url = 'https://apimgmt.www.wow.metoffice.gov.uk/api/observations/byversion'
+    payload = {'site_id': site_id, 'start_time': start, 'end_time': end}
+    response = await http_client.get(url, headers=wow_api_secret, params=payload)
+    response.raise_for_status()
+    return [(i['ReportEndDateTime'], i['DryBulbTemperature_Celsius'],
+            i['RainfallAmount_Millimetre']) for i in response.json()['Object']]
+
+async def fetch_wow_tail(site_id: str, start: datetime, end: datetime) -> List:
+    """Async version of application.fetch_wow_tail"""
+    start = start.strftime('%Y-%m-%dT%H:%M:%S')
+    end = end.strftime('%Y-%m-%dT%H:%M:%S')
+    return await wow_api_calls.do((site_id, start, end),
+                                lambda: request_wow_api(site_id, start, end))
+
+async def get_me_wow(request) -> JSONResponse:
+    """Fetch WOW data for specific GROW sensor from its nearest WOW site"""
+    sensor_id = request.query_params['sensor_id']
+    start = request.query_params['start']
+    end = request.query_params['end']
+    start_dt = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S')
+    end_dt = datetime.strptime(end, '%Y-%m-%dT%H:%M:%S')
+    async with db_pool.acquire() as conn:
+        wow_site = await conn.fetchrow(
+            """SELECT site_id, distance
+                FROM grow_to_wow_mapping
+                WHERE sensor_id = $1""", sensor_id)
+        if wow_site is None:
+            return JSONResponse({'error': 'sensor has no nearest WOW site'}, status_code=404)
+        site_id, distance = wow_site
+        watermark = None
+        backfilled_from = None
+        if await conn.fetchval(SQL_WOW_STORE_EXISTS):
+            stored = await conn.fetchrow(
+                """SELECT last_datetime, backfilled_from
+                    FROM wow_watermarks
+                    WHERE site_id = $1""", site_id)
+            if stored is not None:
+                watermark, backfilled_from = stored
+        rows = []
+        if watermark is not None:
+            rows = [(x[0].strftime('%Y-%m-%dT%H:%M:%S'),
+                    float(x[1]) if x[1] is not None else None,
+                    float(x[2]) if x[2] is not None else None)
+                    for x in await conn.fetch(
+                        """SELECT datetime, air_temp, rainfall
+                            FROM wow_observations
+                            WHERE site_id = $1
+                            AND datetime BETWEEN $2 AND $3
+                            ORDER BY datetime DESC""", site_id, start_dt, end_dt)]
+    newer, older = wow_api_intervals(start_dt, end_dt, watermark, backfilled_from)
+    if newer is not None:
+        rows = await fetch_wow_tail(site_id, *newer) + rows
+    if older is not None:
+        rows = rows + await fetch_wow_tail(site_id, *older)
+    return JSONResponse(wow_response(rows, distance))
+
+async def update_events() -> AsyncIterator[str]:
+    """Async version of live_updates.event_stream"""
+    subscriber = await update_broadcaster.subscribe()
+    try:
+        yield f'retry: {RECONNECT_SECONDS * 1000}\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                try:
+                    await update_broadcaster.listen()
+                except (OSError, asyncpg.PostgresError) as error:
+                    print('Update listener error: ', error)
+                yield ': keep-alive\n\n'
+                continue
+            if event is None:
+                return
+            event_id, payload = event
+            yield f'id: {event_id}\ndata: {payload}\n\n'
+    finally:
+        update_broadcaster.unsubscribe(subscriber)
+
+async def stream_updates(request) -> StreamingResponse:
+    """Stream sensor status changes & new latest readings as server-sent
+    events, as application.stream_updates does, without holding a 
+    worker thread per open stream.
+    """
+    return StreamingResponse(update_events(), media_type='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                    'X-Accel-Buffering': 'no'})
+
+app = Starlette(routes=[Route('/api/indiv_grow_data', get_me_grow),
+                        Route('/api/get_wow_data', get_me_wow),
+                        Route('/api/updates', stream_updates),
+                        Mount('/', app=WSGIMiddleware(flask_app.app))],
+                on_startup=[startup],
+                on_shutdown=[shutdown])
+app.add_middleware(CORSMiddleware, allow_origins=['*'])
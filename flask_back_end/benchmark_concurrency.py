@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import requests
+
+# Requests per round: slow upstream-proxy calls mixed with a cheap
+# DB-backed route, to show whether proxy calls stall the cheap route
+PROXY_PATH = '/api/indiv_grow_data'
+CHEAP_PATH = '/api/check_faulty_grow'
+
+def timed_get(url: str, params: dict) -> float:
+    """Return the seconds taken by one GET request"""
+    start = time.monotonic()
+    requests.get(url, params=params, timeout=120)
+    return time.monotonic() - start
+
+def run_benchmark(base_url: str, concurrency: int, rounds: int, params: dict) -> dict:
+    """Send concurrency proxy requests and concurrency cheap requests
+    at once, rounds times. Return latency statistics per route.
+    """
+    proxy_latencies = []
+    cheap_latencies = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency * 2) as executor:
+        for _ in range(rounds):
+            proxy = [executor.submit(timed_get, base_url + PROXY_PATH, params)
+                    for _ in range(concurrency)]
+            cheap = [executor.submit(timed_get, base_url + CHEAP_PATH,
+                                    {'sensor_id': params['sensor_id']})
+                    for _ in range(concurrency)]
+            proxy_latencies.extend(x.result() for x in proxy)
+            cheap_latencies.extend(x.result() for x in cheap)
+    elapsed = time.monotonic() - start
+    return {'requests_per_second': (len(proxy_latencies) + len(cheap_latencies)) / elapsed,
+            'proxy': summarise(proxy_latencies),
+            'cheap': summarise(cheap_latencies)}
+
+def summarise(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+    return {'p50_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'max_ms': latencies[-1] * 1000}
+
+def main(base_urls: List[str], concurrency: int, rounds: int,
+        sensor_id: str, start: str, end: str):
+    """Compares the sync Flask deployment and the async (asgi.py)
+    deployment of the back end under concurrent load.
+    ie: benchmark_concurrency.py http://localhost:5000 http://localhost:8000
+    """
+    params = {'sensor_id': sensor_id, 'start': start, 'end': end}
+    for base_url in base_urls:
+        results = run_benchmark(base_url.rstrip('/'), concurrency, rounds, params)
+        print(base_url)
+        print(f"  {results['requests_per_second']:.1f} requests/second")
+        for route in ['proxy', 'cheap']:
+            print(f"  {route}: p50 {results[route]['p50_ms']:.0f} ms, "
+                f"p95 {results[route]['p95_ms']:.0f} ms, "
+                f"max {results[route]['max_ms']:.0f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base_urls', nargs='+')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--sensor_id', default='02krq5q5')
+    parser.add_argument('--start', default='2019-05-24T20:00:00')
+    parser.add_argument('--end', default='2019-06-02T20:00:00')
+    args = parser.parse_args()
+    main(args.base_urls, args.concurrency, args.rounds,
+        args.sensor_id, args.start, args.end)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+from typing import List, Tuple
+
+def lttb(points: List[Tuple[float, float]], threshold: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets downsampling. Returns the indexes
+    of at most threshold (x, y) points, sorted by x, that keep the
+    visual shape of the series: peaks and troughs are kept, flat runs
+    are thinned out.
+    """
+    return lttb_aligned([p[0] for p in points], [[p[1] for p in points]], threshold)
+
+def scale(column: List[float]) -> List[float]:
+    """Scale a series to [0, 1] so series of different units weigh
+    the same, None values are kept as None.
+    """
+    values = [y for y in column if y is not None]
+    if values == []:
+        return column
+    low, high = min(values), max(values)
+    spread = (high - low) or 1
+    return [(y - low) / spread if y is not None else None for y in column]
+
+def lttb_aligned(x: List[float], columns: List[List[float]], threshold: int) -> List[int]:
+    """LTTB over several series sharing one sorted x axis, ie: the
+    variables of one sensor. Returns one set of at most threshold
+    indexes for all of them, so they stay aligned. The triangle areas
+    of the series, each scaled to its own range, are summed to pick
+    each bucket's point. None values are left out of the areas.
+    """
+    length = len(x)
+    if threshold >= length:
+        return list(range(length))
+    if threshold < 3:
+        return [0, length - 1][:max(threshold, 0)]
+    columns = [scale(column) for column in columns]
+    selected = [0]
+    # First & last points are always kept, the rest is split in buckets
+    bucket_size = (length - 2) / (threshold - 2)
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        # Average of the next bucket is the third corner of the triangle
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, length)
+        avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        corners = []
+        for column in columns:
+            next_values = [y for y in column[next_start:next_end] if y is not None]
+            if next_values and column[previous] is not None:
+                corners.append((column, column[previous], sum(next_values) / len(next_values)))
+        prev_x = x[previous]
+        best_area = -1
+        best = start
+        for index in range(start, end):
+            area = 0
+            for column, prev_y, avg_y in corners:
+                if column[index] is not None:
+                    area += abs((prev_x - avg_x) * (column[index] - prev_y)
+                                - (prev_x - x[index]) * (avg_y - prev_y))
+            if area > best_area:
+                best_area = area
+                best = index
+        selected.append(best)
+        previous = best
+    selected.append(length - 1)
+    return selected
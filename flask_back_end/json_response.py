@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import gzip
+import zlib
+from typing import Iterator
+
+from flask import Response, request
+from psycopg2 import sql
+
+from use_postgres import UseDatabase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+# Rows fetched per round trip when streaming a JSON array
+STREAM_ROWS = 2000
+# Not text/event-stream, proxies buffer compressed event streams
+COMPRESSIBLE_MIMETYPES = ['application/json', 'text/html', 'text/plain', 'text/csv']
+
+def json_agg_bytes(cursor, query: sql.Composable) -> bytes:
+    """Run a query selecting one JSON value per row and return the
+    rows as a JSON array serialized by Postgres. The array is read as
+    text so it is never decoded & re-encoded in Python.
+    """
+    cursor.execute(sql.SQL("""SELECT COALESCE(json_agg(rows.value), '[]')::text
+                            FROM ({}) AS rows(value)""").format(query))
+    return cursor.fetchone()[0].encode()
+
+def columnar_json_bytes(cursor, table_name: str, query_from: sql.Composable) -> bytes:
+    """Return the rows of table_name matched by query_from (the FROM,
+    JOIN & WHERE clauses) as one JSON object holding an array per
+    column, ie: {"sensor_id": [...], "latitude": [...]}. Column names
+    are written once instead of once per row.
+    """
+    cursor.execute("""SELECT column_name FROM information_schema.columns
+                    WHERE table_name = %s
+                    ORDER BY ordinal_position""", (table_name,))
+    columns = [x[0] for x in cursor.fetchall()]
+    arrays = sql.SQL(', ').join(
+        sql.SQL('{}, COALESCE(json_agg({}.{}), {})').format(
+            sql.Literal(column), sql.Identifier(table_name),
+            sql.Identifier(column), sql.Literal('[]'))
+        for column in columns)
+    cursor.execute(sql.SQL("""SELECT json_build_object({})::text {}""").format(
+                            arrays, query_from))
+    return cursor.fetchone()[0].encode()
+
+def stream_json_array(aurora_creds: dict, query: sql.Composable) -> Response:
+    """Stream the rows of a query selecting one JSON value per row as a
+    JSON array, STREAM_ROWS rows at a time from a server side cursor,
+    so large results are never held in memory whole.
+    """
+    def generate() -> Iterator[bytes]:
+        with UseDatabase(aurora_creds, pooled=True) as cursor:
+            with cursor.connection.cursor(name='json_stream') as stream:
+                stream.itersize = STREAM_ROWS
+                stream.execute(sql.SQL("""SELECT rows.value::text
+                                        FROM ({}) AS rows(value)""").format(query))
+                yield b'['
+                separator = b''
+                while True:
+                    rows = stream.fetchmany(STREAM_ROWS)
+                    if rows == []:
+                        break
+                    yield separator + b','.join(x[0].encode() for x in rows)
+                    separator = b','
+                yield b']'
+    return Response(generate(), mimetype='application/json')
+
+def accepted_encoding() -> str:
+    """Return the best compression the client accepts: 'br' (if the
+    brotli package is installed), 'gzip' or None.
+    """
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_bytes(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+def compress_stream(chunks: Iterator[bytes], encoding: str) -> Iterator[bytes]:
+    """Compress a streamed response chunk by chunk"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        # wbits=31 writes a gzip header & trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+def compress_response(response: Response) -> Response:
+    """after_request hook compressing JSON & text responses with
+    gzip or brotli when the client accepts it.
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < MIN_COMPRESS_BYTES:
+            return response
+        response.set_data(compress_bytes(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import itertools
+import queue
+import select
+import threading
+import time
+from typing import Iterator
+
+import psycopg2
+
+from use_postgres import UPDATES_CHANNEL
+
+# Seconds between SSE keep-alive comments, below common proxy idle timeouts
+HEARTBEAT_SECONDS = 15
+# Updates buffered per client before the client is dropped as too slow
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Seconds to wait before reconnecting after the listening connection fails
+RECONNECT_SECONDS = 5
+
+class UpdateBroadcaster:
+    """LISTENs on UPDATES_CHANNEL with one dedicated connection and
+    copies every notification payload to each subscribed client's
+    queue. The listening thread starts with the first subscriber.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.event_ids = itertools.count(1)
+        self.thread = None
+
+    def subscribe(self, aurora_creds: dict) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, args=(aurora_creds,),
+                                                daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, payload: str) -> None:
+        event = (next(self.event_ids), payload)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Close the slow client's stream, it reloads on reconnect
+                self.unsubscribe(subscriber)
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(None)
+
+    def listen(self, aurora_creds: dict) -> None:
+        """Forward notifications forever, reconnecting on failure"""
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**aurora_creds)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {UPDATES_CHANNEL};')
+                while True:
+                    if select.select([conn], [], [], HEARTBEAT_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.publish(conn.notifies.pop(0).payload)
+            except Exception as error:
+                # Any failure (Postgres, select, publish) must not end the
+                # thread, subscribe() never starts another one
+                print('Update listener error: ', error)
+                if conn is not None:
+                    conn.close()
+                time.sleep(RECONNECT_SECONDS)
+
+def event_stream(broadcaster: UpdateBroadcaster, aurora_creds: dict) -> Iterator[str]:
+    """Yield updates as server-sent events, with keep-alive comments
+    while there are none. Ends when the client is dropped as too slow.
+    """
+    subscriber = broadcaster.subscribe(aurora_creds)
+    try:
+        yield f'retry: {RECONNECT_SECONDS * 1000}\n\n'
+        while True:
+            try:
+                event = subscriber.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if event is None:
+                return
+            event_id, payload = event
+            yield f'id: {event_id}\ndata: {payload}\n\n'
+    finally:
+        broadcaster.unsubscribe(subscriber)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import asyncio
+import hashlib
+import math
+import os
+import threading
+import time
+from typing import Awaitable, Callable
+
+from flask import Response, request
+
+from json_response import MIN_COMPRESS_BYTES, accepted_encoding, compress_bytes
+from use_postgres import UseDatabase, fetch_data_version
+
+# Seconds between checks of the data version bumped by the ETL scripts
+VERSION_CHECK_INTERVAL = int(os.environ.get('GROW_VERSION_CHECK_SECONDS', 30))
+
+class DataVersion:
+    """Remembers the ETL data version, reading it from Aurora at most
+    once every check_interval seconds. One request re-reads it while
+    the others carry on with the last version read.
+    """
+
+    def __init__(self, check_interval: int = VERSION_CHECK_INTERVAL) -> None:
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = -math.inf
+        self.value = (None, None)
+
+    def current(self, aurora_creds: dict) -> tuple:
+        """Return (version, updated_at) of the data"""
+        if time.monotonic() - self.checked <= self.check_interval:
+            return self.value
+        # Only wait for another thread's read when there is no version yet
+        if not self.lock.acquire(blocking=self.checked == -math.inf):
+            return self.value
+        try:
+            if time.monotonic() - self.checked > self.check_interval:
+                with UseDatabase(aurora_creds, pooled=True) as cursor:
+                    self.value = fetch_data_version(cursor)
+                self.checked = time.monotonic()
+        finally:
+            self.lock.release()
+        return self.value
+
+class ResponseCache:
+    """Holds pre-serialized response bodies, valid until the data
+    version changes.
+    """
+
+    def __init__(self, data_version: DataVersion) -> None:
+        self.data_version = data_version
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def get(self, key: str, aurora_creds: dict, build: Callable[[], bytes]) -> dict:
+        """Return the cached entry for key, building the body again
+        if the data version has changed since it was cached.
+        """
+        version, updated_at = self.data_version.current(aurora_creds)
+        entry = self.entries.get(key)
+        if entry is None or entry['version'] != version:
+            body = build()
+            entry = {'version': version,
+                    'updated_at': updated_at,
+                    'body': body,
+                    'encoded': dict(),
+                    'etag': hashlib.sha1(f'{key}:{version}'.encode() + body).hexdigest()}
+            with self.lock:
+                self.entries[key] = entry
+        return entry
+
+    def response(self, key: str, aurora_creds: dict, build: Callable[[], bytes],
+                mimetype: str = 'application/json') -> Response:
+        """Return the cached body with ETag and Last-Modified headers,
+        or 304 Not Modified when the client already has it. Bodies are
+        compressed once per accepted encoding and cached with the entry.
+        """
+        entry = self.get(key, aurora_creds, build)
+        encoding = accepted_encoding()
+        if encoding is None or len(entry['body']) < MIN_COMPRESS_BYTES:
+            response = Response(entry['body'], mimetype=mimetype)
+            response.set_etag(entry['etag'])
+        else:
+            if encoding not in entry['encoded']:
+                entry['encoded'][encoding] = compress_bytes(entry['body'], encoding)
+            response = Response(entry['encoded'][encoding], mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f"{entry['etag']}-{encoding}")
+        response.vary.add('Accept-Encoding')
+        if entry['updated_at'] is not None:
+            response.last_modified = entry['updated_at']
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+class TTLCache:
+    """Thread-safe cache whose entries expire ttl seconds after being
+    set. The oldest entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, ttl: int, max_entries: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() > entry[0]:
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self.entries) > self.max_entries:
+                # dicts keep insertion order, the first key is the oldest
+                del self.entries[next(iter(self.entries))]
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight
+    call whose result is shared by every caller, then cached for ttl 
+    seconds. Errors and empty results are not cached.
+    """
+
+    def __init__(self, ttl: int) -> None:
+        self.results = TTLCache(ttl)
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, fetch: Callable):
+        """Return the result of fetch() for key, calling it only if no
+        identical call is in flight or cached.
+        """
+        result = self.results.get(key)
+        if result is not None:
+            return result
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event()}
+                self.calls[key] = call
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fetch()
+            if call['result']:
+                self.results.set(key, call['result'])
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['result']
+
+class AsyncSingleFlight:
+    """asyncio version of SingleFlight for the async serving mode.
+    Concurrent calls with the same key await one shared task, whose
+    result is then cached for ttl seconds unless it is empty.
+    """
+
+    def __init__(self, ttl: int) -> None:
+        self.results = TTLCache(ttl)
+        self.calls = dict()
+
+    async def do(self, key, fetch: Callable[[], Awaitable]):
+        """Return the result of await fetch() for key, calling it only if
+        no identical call is in flight or cached.
+        """
+        result = self.results.get(key)
+        if result is not None:
+            return result
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(self._call(key, fetch))
+            self.calls[key] = call
+        # A disconnecting client must not cancel the call others await
+        return await asyncio.shield(call)
+
+    async def _call(self, key, fetch: Callable[[], Awaitable]):
+        try:
+            result = await fetch()
+            if result:
+                self.results.set(key, result)
+            return result
+        finally:
+            del self.calls[key]
+
+class VersionedValue:
+    """Holds a value built from Aurora, rebuilt when the data version
+    changes. Used for in-memory indexes over the ETL data.
+    """
+
+    def __init__(self, data_version: DataVersion, build: Callable) -> None:
+        self.data_version = data_version
+        self.build = build
+        self.lock = threading.Lock()
+        self.version = None
+        self.value = None
+
+    def get(self, aurora_creds: dict):
+        version, _ = self.data_version.current(aurora_creds)
+        with self.lock:
+            if self.value is None or self.version != version:
+                self.value = self.build()
+                self.version = version
+            return self.value
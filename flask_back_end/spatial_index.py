@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import math
+from collections import defaultdict
+from typing import List
+
+# Grid cell size in degrees, roughly 55km of latitude
+CELL_SIZE = 0.5
+
+def clamp(value: float, lowest: float, highest: float) -> float:
+    return max(lowest, min(value, highest))
+
+class SensorGridIndex:
+    """In-memory grid index over GROW sensor latitude/longitude.
+    Sensors are dicts shaped like all_sensor_info rows plus a 'status'.
+    """
+
+    def __init__(self, sensors: List[dict], cell_size: float = CELL_SIZE) -> None:
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        for sensor in sensors:
+            if sensor['latitude'] is None or sensor['longitude'] is None:
+                continue
+            self.cells[self._cell(sensor['latitude'], sensor['longitude'])].append(sensor)
+
+    def _cell(self, lat: float, lon: float) -> tuple:
+        return (math.floor(float(lat) / self.cell_size),
+                math.floor(float(lon) / self.cell_size))
+
+    def query(self, min_lat: float, min_lon: float, max_lat: float,
+            max_lon: float, status: str = None) -> List[dict]:
+        """Return sensors inside the box, optionally only those with status.
+        A box with min_lon > max_lon crosses the antimeridian. Bounds
+        are clamped to valid latitudes & longitudes.
+        """
+        min_lat, max_lat = clamp(min_lat, -90, 90), clamp(max_lat, -90, 90)
+        min_lon, max_lon = clamp(min_lon, -180, 180), clamp(max_lon, -180, 180)
+        if min_lon > max_lon:
+            return self.query(min_lat, min_lon, max_lat, 180, status) + \
+                    self.query(min_lat, -180, max_lat, max_lon, status)
+        min_row, min_col = self._cell(min_lat, min_lon)
+        max_row, max_col = self._cell(max_lat, max_lon)
+        rows = range(min_row, max_row + 1)
+        cols = range(min_col, max_col + 1)
+        # Large boxes look through the occupied cells, not every cell
+        if len(rows) * len(cols) > len(self.cells):
+            cells = [x for x in self.cells if x[0] in rows and x[1] in cols]
+        else:
+            cells = [(row, col) for row in rows for col in cols]
+        results = []
+        for cell in cells:
+            for sensor in self.cells.get(cell, []):
+                if status is not None and sensor['status'] != status:
+                    continue
+                if min_lat <= float(sensor['latitude']) <= max_lat and \
+                    min_lon <= float(sensor['longitude']) <= max_lon:
+                    results.append(sensor)
+        return results
+
+# Zoom levels clustered, following Google Maps zoom numbering
+MAX_CLUSTER_ZOOM = 18
+# Cluster cells per 256px map tile side, ie: one cluster per 64px
+CELLS_PER_TILE = 4
+# Sensor statuses counted per cluster, any other status counts as 'unknown'
+STATUSES = ['healthy', 'recovered', 'faulty', 'unknown']
+
+def mercator_xy(lat: float, lon: float) -> tuple:
+    """Project lat/lon to Web Mercator x/y in [0, 1], as used by Google Maps"""
+    lat = max(min(float(lat), 85.05112878), -85.05112878)
+    sin_lat = math.sin(math.radians(lat))
+    x = (float(lon) + 180) / 360
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0), 1 - 1e-12), min(max(y, 0), 1 - 1e-12)
+
+class SensorClusters:
+    """Sensor clusters for every zoom level, built once from a quadtree
+    grid of Web Mercator cells. A cell at zoom z is split into four
+    cells at zoom z + 1, so each level is aggregated from the level
+    below it.
+    """
+
+    def __init__(self, sensors: List[dict], max_zoom: int = MAX_CLUSTER_ZOOM) -> None:
+        self.max_zoom = max_zoom
+        finest = dict()
+        for sensor in sensors:
+            if sensor['latitude'] is None or sensor['longitude'] is None:
+                continue
+            lat = float(sensor['latitude'])
+            lon = float(sensor['longitude'])
+            x, y = mercator_xy(lat, lon)
+            cells = CELLS_PER_TILE * 2 ** max_zoom
+            cell = (int(x * cells), int(y * cells))
+            cluster = finest.setdefault(cell, self._empty_cluster())
+            self._add(cluster, lat, lon, sensor.get('status'), 1, lat, lon, lat, lon, sensor)
+        self.levels = {max_zoom: finest}
+        for zoom in range(max_zoom - 1, -1, -1):
+            level = dict()
+            for (col, row), child in self.levels[zoom + 1].items():
+                cluster = level.setdefault((col >> 1, row >> 1), self._empty_cluster())
+                self._merge(cluster, child)
+            self.levels[zoom] = level
+
+    @staticmethod
+    def _empty_cluster() -> dict:
+        return {'count': 0, 'lat_sum': 0.0, 'lon_sum': 0.0,
+                'counts': {status: 0 for status in STATUSES},
+                'bbox': [90.0, 180.0, -90.0, -180.0], 'sensor': None}
+
+    @staticmethod
+    def _add(cluster: dict, lat: float, lon: float, status: str, count: int,
+            min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+            sensor: dict = None) -> None:
+        cluster['count'] += count
+        cluster['lat_sum'] += lat * count
+        cluster['lon_sum'] += lon * count
+        cluster['counts'][status if status in STATUSES else 'unknown'] += count
+        bbox = cluster['bbox']
+        cluster['bbox'] = [min(bbox[0], min_lat), min(bbox[1], min_lon),
+                            max(bbox[2], max_lat), max(bbox[3], max_lon)]
+        # Single sensor clusters are returned as the sensor itself
+        cluster['sensor'] = sensor if cluster['count'] == 1 else None
+
+    def _merge(self, cluster: dict, child: dict) -> None:
+        sensor = child['sensor'] if cluster['count'] == 0 else None
+        cluster['count'] += child['count']
+        cluster['lat_sum'] += child['lat_sum']
+        cluster['lon_sum'] += child['lon_sum']
+        for status in STATUSES:
+            cluster['counts'][status] += child['counts'][status]
+        bbox, child_bbox = cluster['bbox'], child['bbox']
+        cluster['bbox'] = [min(bbox[0], child_bbox[0]), min(bbox[1], child_bbox[1]),
+                            max(bbox[2], child_bbox[2]), max(bbox[3], child_bbox[3])]
+        cluster['sensor'] = sensor
+
+    def query(self, zoom: int, min_lat: float = -90, min_lon: float = -180,
+            max_lat: float = 90, max_lon: float = 180) -> List[dict]:
+        """Return the clusters at zoom whose centroid is inside the box:
+        sensor count by status, centroid and bounding box to zoom into.
+        """
+        zoom = max(0, min(zoom, self.max_zoom))
+        results = []
+        for cluster in self.levels[zoom].values():
+            lat = cluster['lat_sum'] / cluster['count']
+            lon = cluster['lon_sum'] / cluster['count']
+            if not min_lat <= lat <= max_lat:
+                continue
+            if min_lon <= max_lon and not min_lon <= lon <= max_lon:
+                continue
+            if min_lon > max_lon and max_lon < lon < min_lon:
+                continue
+            results.append({'count': cluster['count'],
+                            'counts': cluster['counts'],
+                            'latitude': lat,
+                            'longitude': lon,
+                            'bbox': cluster['bbox'],
+                            'sensor': cluster['sensor']})
+        return results
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import json
+import mimetypes
+import os
+
+from flask import Response, request, send_from_directory, url_for
+
+from build_assets import DIST_DIR, MANIFEST_NAME
+
+# Built assets never change, their file name changes with their content
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Precompressed copies written by build_assets.py, best first
+PRECOMPRESSED = [('br', '.br'), ('gzip', '.gz')]
+
+def load_manifest() -> dict:
+    """Return the manifest written by build_assets.py, empty if the
+    assets have not been built, ie: when developing locally.
+    """
+    try:
+        with open(os.path.join(DIST_DIR, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return dict()
+
+manifest = load_manifest()
+
+def asset_url(path: str) -> str:
+    """Template helper returning the URL of a static file, ie:
+    asset_url('javascript/grow_map.js'). Built assets are served
+    fingerprinted, unbuilt ones from static/ as before.
+    """
+    if path in manifest:
+        return url_for('serve_asset', filename=manifest[path])
+    return url_for('static', filename=path)
+
+def serve_asset(filename: str) -> Response:
+    """Serve a built asset with long-lived immutable cache headers,
+    using its precompressed copy when the client accepts it.
+    """
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in PRECOMPRESSED:
+        if (request.accept_encodings[encoding]
+                and os.path.isfile(os.path.join(DIST_DIR, filename + suffix))):
+            response = send_from_directory(DIST_DIR, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(DIST_DIR, filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
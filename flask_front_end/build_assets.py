@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# Built assets & their manifest, served by the /assets route
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_NAME = 'manifest.json'
+# Text assets are precompressed, images are already compressed
+COMPRESSIBLE_EXTENSIONS = ['.js', '.css', '.svg', '.json']
+
+def minify(path: str, content: bytes) -> bytes:
+    """Minify JavaScript with rjsmin if it is installed"""
+    if path.endswith('.js') and rjsmin is not None:
+        return rjsmin.jsmin(content.decode()).encode()
+    return content
+
+def fingerprint(path: str, content: bytes) -> str:
+    """Add a content hash to a file name, ie: javascript/grow_map.js ->
+    javascript/grow_map.1a2b3c4d5e6f.js
+    """
+    stem, extension = os.path.splitext(path)
+    return f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+
+def write_asset(built_path: str, content: bytes) -> None:
+    """Write an asset and its .gz & .br precompressed copies"""
+    full_path = os.path.join(DIST_DIR, built_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as asset:
+        asset.write(content)
+    if os.path.splitext(built_path)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return
+    with open(full_path + '.gz', 'wb') as asset:
+        asset.write(gzip.compress(content, compresslevel=9))
+    if brotli is not None:
+        with open(full_path + '.br', 'wb') as asset:
+            asset.write(brotli.compress(content, quality=11))
+
+def build_assets() -> dict:
+    """Minify, fingerprint & precompress every file in static/ to
+    static/dist/, then write the manifest mapping source paths to
+    built paths, used by the asset_url template helper.
+    """
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest = dict()
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [x for x in dirs if os.path.join(root, x) != DIST_DIR]
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, STATIC_DIR).replace(os.sep, '/')
+            with open(full_path, 'rb') as source:
+                content = minify(path, source.read())
+            manifest[path] = fingerprint(path, content)
+            write_asset(manifest[path], content)
+    with open(os.path.join(DIST_DIR, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return manifest
+
+def main():
+    """Builds the front end's static assets. Run before bundling
+    the front end for Elastic Beanstalk.
+    """
+    if rjsmin is None:
+        print('rjsmin is not installed, JavaScript is not minified')
+    if brotli is None:
+        print('brotli is not installed, only .gz copies are written')
+    for path, built_path in sorted(build_assets().items()):
+        print(path, '->', built_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import time
+
+import psycopg2
+
+from use_postgres import UseDatabase, fetch_data_version
+
+# Seconds between checks of the data version bumped by the ETL scripts
+VERSION_CHECK_INTERVAL = int(os.environ.get('GROW_VERSION_CHECK_SECONDS', 30))
+
+# Statistics shown before Aurora has been read or while it has no data
+EMPTY_STATS = {'sensors': 0, 'owners': 0, 'healthy': 0, 'recovered': 0, 'faulty': 0}
+
+def fetch_site_stats(cursor) -> dict:
+    """Return sensor, owner & sensor status counts in one query. Sensors
+    without a sensor_health row yet count as healthy, all of them do
+    before the anomaly detection has first run.
+    """
+    cursor.execute("""SELECT to_regclass('all_sensor_info') IS NOT NULL,
+                        to_regclass('sensor_health') IS NOT NULL""")
+    sensors_exist, health_exists = cursor.fetchone()
+    if not sensors_exist:
+        return dict(EMPTY_STATS)
+    if health_exists:
+        cursor.execute("""SELECT COUNT(*),
+                            COUNT(DISTINCT s.owner_id),
+                            COUNT(*) FILTER (WHERE COALESCE(h.status, 'healthy') = 'healthy'),
+                            COUNT(*) FILTER (WHERE h.status = 'recovered'),
+                            COUNT(*) FILTER (WHERE h.status = 'faulty')
+                        FROM all_sensor_info s
+                        LEFT JOIN sensor_health h USING (sensor_id);""")
+    else:
+        cursor.execute("""SELECT COUNT(*), COUNT(DISTINCT owner_id), COUNT(*), 0, 0
+                        FROM all_sensor_info;""")
+    return dict(zip(['sensors', 'owners', 'healthy', 'recovered', 'faulty'], cursor.fetchone()))
+
+class SiteStats:
+    """Holds the statistics shown on the /login & /all_grow_map pages.
+    A background thread re-reads them when the ETL scripts bump the data
+    version, so pages are rendered without waiting on Aurora.
+    """
+
+    def __init__(self, check_interval: int = VERSION_CHECK_INTERVAL) -> None:
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.stats = None
+        self.thread = None
+
+    def start(self, aurora_creds: dict) -> None:
+        """Load the statistics, then keep them current in the background.
+        If the first load fails, pages show zeros until a refresh succeeds.
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.refresh_forever,
+                                            args=(aurora_creds,), daemon=True)
+            self.thread.start()
+        try:
+            self.refresh(aurora_creds)
+        except psycopg2.Error as error:
+            print('Site statistics load error: ', error)
+
+    def current(self) -> dict:
+        return self.stats if self.stats is not None else EMPTY_STATS
+
+    def refresh(self, aurora_creds: dict) -> None:
+        """Re-read the statistics if the data version has changed. Aurora
+        is queried without holding the lock, which only guards the swap.
+        """
+        with UseDatabase(aurora_creds, pooled=True) as cursor:
+            version, _ = fetch_data_version(cursor)
+            if version == self.version and self.stats is not None:
+                return
+            stats = fetch_site_stats(cursor)
+        with self.lock:
+            self.stats = stats
+            self.version = version
+
+    def refresh_forever(self, aurora_creds: dict) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.refresh(aurora_creds)
+            except psycopg2.Error as error:
+                # Keep serving the last statistics until Aurora is back
+                print('Site statistics refresh error: ', error)
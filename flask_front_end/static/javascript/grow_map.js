@@ -7,6 +7,13 @@
 google.charts.load('current', {'packages':['corechart']});
 
 var activeWindow;
+// Map, its sensor markers & the sensor status picked with the Plot buttons
+var map;
+var markers = [];
+var plottedStatus = null;
+var sensorRequests = 0;
+// Below this zoom level sensors are fetched & plotted as clusters
+var INDIVIDUAL_SENSOR_ZOOM = 12;
 
 // Used to clear tables & graphs
 function clearBox(elementID)
@@ -64,25 +71,110 @@ function addInfoWindow(marker, message) {
     });
 }
 
-// Function which calls an api endpoint, receives data, 
-// then calls the initMap function with that data.
+// Functions which pick the GROW sensors to plot, only the sensors
+// inside the visible part of the map are fetched.
 function getSensorData() {
-    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/all_grow_true_json', initMap);
+    plotSensors('all');
 }
 
 function getHealthyData() {
-    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/all_grow_healthy_json', initMap);
+    plotSensors('healthy');
 }
 
 function getRecoveredData() {
-    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/all_grow_recovered_json', initMap);
+    plotSensors('recovered');
 }
 
 function getFaultyData() {
-    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/all_grow_faulty_json', initMap);
+    plotSensors('faulty');
 }
 
-// Queries backend endpoint 'indiv_grow_data', passes data to processGrowData function
+function plotSensors(status) {
+    plottedStatus = status;
+    loadSensorsInView();
+}
+
+// Queries backend endpoint 'sensor_clusters' (zoomed out) or 
+// 'sensors_in_bbox' (zoomed in) for the plotted sensors inside the 
+// visible map, passes data to drawClusters or drawSensors function.
+// Called again every time the map stops moving.
+function loadSensorsInView() {
+    if (plottedStatus == null || map.getBounds() == null) {
+        return;
+    }
+    var bounds = map.getBounds();
+    params = {
+        min_lat: bounds.getSouthWest().lat(),
+        min_lon: bounds.getSouthWest().lng(),
+        max_lat: bounds.getNorthEast().lat(),
+        max_lon: bounds.getNorthEast().lng()
+    }
+    if (plottedStatus != 'all') {
+        params['status'] = plottedStatus;
+    }
+    // Only draw the response to the latest request
+    var request = ++sensorRequests;
+    if (map.getZoom() < INDIVIDUAL_SENSOR_ZOOM) {
+        params['zoom'] = map.getZoom();
+        $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/sensor_clusters', params, function(data) {
+            if (request == sensorRequests) {
+                drawClusters(data);
+            }
+        });
+    } else {
+        $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/sensors_in_bbox', params, function(data) {
+            if (request == sensorRequests) {
+                drawSensors(data);
+            }
+        });
+    }
+}
+
+// Plots sensor clusters on map, each labelled with its number of
+// sensors. Clusters of one sensor are plotted as that sensor.
+function drawClusters(clusters) {
+    var sensors = [];
+    for (var i = 0; i < clusters.length; i++) {
+        if (clusters[i].count == 1) {
+            sensors.push(clusters[i].sensor);
+        }
+    }
+    drawSensors(sensors);
+    for (var i = 0; i < clusters.length; i++) {
+        if (clusters[i].count == 1) {
+            continue;
+        }
+        var marker = new google.maps.Marker({
+            position: new google.maps.LatLng(clusters[i].latitude, clusters[i].longitude),
+            map: map,
+            label: String(clusters[i].count),
+            title: 'Healthy: ' + clusters[i].counts.healthy +
+                ', Recovered: ' + clusters[i].counts.recovered +
+                ', Faulty: ' + clusters[i].counts.faulty
+            });
+        markers.push(marker);
+        addClusterZoom(marker, clusters[i].bbox);
+    }
+}
+
+// Zooms the map into a cluster's sensors when the cluster is clicked
+function addClusterZoom(marker, bbox) {
+    google.maps.event.addListener(marker, 'click', function() {
+        map.fitBounds(new google.maps.LatLngBounds({lat: bbox[0], lng: bbox[1]},
+                                                    {lat: bbox[2], lng: bbox[3]}));
+    });
+}
+
+// Removes all sensor markers from the map
+function clearMarkers() {
+    for (var i = 0; i < markers.length; i++) {
+        markers[i].setMap(null);
+    }
+    markers = [];
+}
+
+// Queries backend endpoint 'grow_series', passes data to processGrowData function
+// Long intervals are returned downsampled or as hourly/daily means
 function getGrowData() {
     start = document.getElementById('start_date').value; 
     end = document.getElementById('end_date').value; 
@@ -92,7 +184,7 @@ function getGrowData() {
         end: end, 
         sensor_id: sensor_id
     }
-    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/indiv_grow_data', params, processGrowData);
+    $.getJSON('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/grow_series', params, processGrowData);
 }
 
 // Queries backend endpoint 'check_faulty_grow', passes data to processGrowFaults
@@ -313,18 +405,25 @@ function drawWowChart(distance, air_temperature, datetimes, rainfall) {
     chart.draw(data, options);
 }
 
-// Creates Google Maps map and plots GROW sensor markers on map
-function initMap(data) {
+// Creates Google Maps map, plotted sensors are loaded when it stops moving
+function initMap() {
     // Create the map centered on the United Kingdom.
-    var map = new google.maps.Map(document.getElementById('map'), {
+    map = new google.maps.Map(document.getElementById('map'), {
         zoom: 4,
         center: {lat: 55.3781, lng: 3.4360},
         mapTypeId: 'terrain'
     });
+    map.addListener('idle', loadSensorsInView);
+}
 
-    // Image to use for map pinpoint icon
+// Plots GROW sensor markers on map, replacing the previous markers
+function drawSensors(data) {
+    clearMarkers();
+
+    // Image to use for map pinpoint icon, its (fingerprinted) URL
+    // is set on the map element by the page template
     var image = {
-        url: 'static/images/google-maps-location-icon.jpg',
+        url: document.getElementById('map').dataset.markerIcon,
         scaledSize : new google.maps.Size(12, 12),
     };
 
@@ -347,9 +446,9 @@ function initMap(data) {
         var marker = new google.maps.Marker({
             position: new google.maps.LatLng(grow[sensor].latitude, grow[sensor].longitude),
             map: map, 
-            animation: google.maps.Animation.DROP,
             icon: image
             });
+        markers.push(growCircle, marker);
         
         // Adds Info Window to show info when GROW sensor is clicked
         addInfoWindow(marker, ('Address: ' + grow[sensor].address +
@@ -374,3 +473,32 @@ function initMap(data) {
 
 // Anthony Delivanis
 
+
+// Listens to backend endpoint 'updates' and refreshes the health status
+// shown for the selected sensor when the anomaly pipeline changes it.
+// Only while the Live status updates box is ticked: every open stream
+// holds a backend connection.
+var updateSource = null;
+
+function toggleUpdates(enabled) {
+    if (!enabled) {
+        if (updateSource != null) {
+            updateSource.close();
+            updateSource = null;
+        }
+        return;
+    }
+    if (updateSource != null) {
+        return;
+    }
+    updateSource = new EventSource('http://flask-env.hhxgagpxbh.eu-west-1.elasticbeanstalk.com/api/updates');
+    var health_statuses = {healthy: 'Healthy', faulty: 'Not Healthy', recovered: 'Recovered State'};
+    updateSource.onmessage = function(event) {
+        var update = JSON.parse(event.data);
+        if (update['type'] != 'status' || update['sensor_id'] != document.getElementById('sensor_id').value) {
+            return;
+        }
+        document.getElementById('grow_health_status').innerHTML = health_statuses[update['status']];
+        document.getElementById('grow_anomaly_date').innerHTML = update['last_anomaly'];
+    };
+}
@@ -1,86 +1,94 @@
 #!/usr/bin/env python3
 
-import ast
-import base64
 import argparse
-from datetime import timedelta
 
-import boto3
-from psycopg2 import sql
-from botocore.exceptions import ClientError
+from credentials import AURORA_SECRET, aurora_creds_from_secret, get_secret
+from use_postgres import UPDATES_CHANNEL, UseDatabase, bump_data_version
 
-from use_postgres import UseDatabase
+def update_days_since_anomaly(cursor) -> None:
+    """Calculate the delta between the most recent anomaly and the
+    most recent recorded date of every GROW table in one statement,
+    joining against the 'grow_watermarks' table maintained by 
+    extract_all_grow_data.py.
+    """
+    sql_update = """UPDATE public.grow_anomalies g
+                    SET days_since_anomaly = DATE_PART('day', w.last_datetime - a.last_anomaly)
+                    FROM (SELECT grow_table, 
+                            MAX(GREATEST(soil_date, light_date, air_date)) AS last_anomaly
+                        FROM grow_anomalies
+                        GROUP BY grow_table) a
+                    JOIN grow_watermarks w 
+                    ON w.grow_table = a.grow_table
+                    WHERE g.grow_table = a.grow_table;"""
+    cursor.execute(sql_update)
+
+def refresh_sensor_health(cursor) -> None:
+    """Rebuild the 'sensor_health' table from 'all_sensor_info' and
+    'grow_anomalies', so the Flask apps can look up the healthy,
+    recovered or faulty status of a sensor by index instead of
+    recomputing it on every request. Sensors whose status changed
+    are sent on the UPDATES_CHANNEL notification channel.
+    """
+    sql_create = """CREATE TABLE IF NOT EXISTS sensor_health(
+                    sensor_id varchar(8) PRIMARY KEY,
+                    owner_id varchar(36),
+                    status varchar(9),
+                    last_anomaly timestamp,
+                    days_since_anomaly integer
+                    );
+                    CREATE INDEX IF NOT EXISTS sensor_health_owner_idx
+                    ON sensor_health (owner_id, status);
+                    CREATE INDEX IF NOT EXISTS sensor_health_status_idx
+                    ON sensor_health (status);"""
+    cursor.execute(sql_create)
+    cursor.execute("""CREATE TEMP TABLE previous_health ON COMMIT DROP AS
+                    SELECT sensor_id, status FROM sensor_health;""")
+    cursor.execute("""DELETE FROM sensor_health;""")
+    sql_insert = """INSERT INTO sensor_health
+                    SELECT DISTINCT ON (s.sensor_id) 
+                        s.sensor_id, 
+                        s.owner_id,
+                        CASE WHEN a.grow_table IS NULL THEN 'healthy'
+                            WHEN a.days_since_anomaly >= 2 THEN 'recovered'
+                            WHEN a.days_since_anomaly < 2 THEN 'faulty'
+                            ELSE 'unknown' END,
+                        a.last_anomaly,
+                        a.days_since_anomaly
+                    FROM all_sensor_info s
+                    LEFT JOIN (SELECT grow_table,
+                                MAX(GREATEST(soil_date, light_date, air_date)) AS last_anomaly,
+                                MAX(days_since_anomaly) AS days_since_anomaly
+                            FROM grow_anomalies
+                            GROUP BY grow_table) a
+                    ON a.grow_table = CONCAT('grow_data_', s.sensor_id);"""
+    cursor.execute(sql_insert)
+    # Notifications are delivered to the back end's listeners on commit
+    sql_notify = """SELECT pg_notify(%s, json_build_object(
+                        'type', 'status',
+                        'sensor_id', h.sensor_id,
+                        'status', h.status,
+                        'previous_status', p.status,
+                        'last_anomaly', h.last_anomaly)::text)
+                    FROM sensor_health h
+                    LEFT JOIN previous_health p USING (sensor_id)
+                    WHERE h.status IS DISTINCT FROM p.status;"""
+    cursor.execute(sql_notify, (UPDATES_CHANNEL,))
 
 def main():
     """Connects to Aurora Database, calculates the delta between
     most recent GROW anomaly and most recent GROW recorded date.
     Inserts the delta as 'days_since_anomaly' column in 
-    'grow_anomalies' Aurora table.
+    'grow_anomalies' Aurora table, refreshes 'sensor_health' and
+    bumps the data version so the Flask apps drop cached responses.
+    detect_anomalies.py runs these steps at the end of every
+    detection run, so this script is only needed for manual reruns.
     """
-    aurora_secret = get_aurora_secret()
-    aurora_creds = {
-        'host': aurora_secret['host'],
-        'port': aurora_secret['port'],
-        'dbname': aurora_secret['engine'],
-        'user': aurora_secret['username'],
-        'password': aurora_secret['password']
-    }
-    with UseDatabase(aurora_creds) as cursor:
-        sql_anomaly = """SELECT grow_table, 
-                        MAX(GREATEST(soil_date, light_date, air_date)) 
-                        FROM grow_anomalies
-                        GROUP BY grow_table;"""
-        cursor.execute(sql_anomaly)
-        anomaly_dates = cursor.fetchall()
-        all_deltas = []
-        for i in anomaly_dates:
-            sql_select = sql.SQL("""SELECT MAX(datetime)
-                                FROM {}""").format(sql.Identifier(i[0]))
-            cursor.execute(sql_select)
-            result_datetime = cursor.fetchone()
-            all_deltas.append([i[0], result_datetime[0] - i[1]])
-        for i in all_deltas:
-            sql_update = sql.SQL("""UPDATE public.grow_anomalies
-                                    SET days_since_anomaly = {}
-                                    WHERE grow_table = {}""").format(
-                                        sql.Literal(i[1].days),
-                                        sql.Literal(i[0])
-                                    )
-            cursor.execute(sql_update)
+    aurora_secret = get_secret(AURORA_SECRET)
+    aurora_creds = aurora_creds_from_secret(aurora_secret)
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        update_days_since_anomaly(cursor)
+        refresh_sensor_health(cursor)
+        bump_data_version(cursor)
 
-def get_aurora_secret():
-    """Retrieve AWS RDS Aurora credentials from AWS Secrets Manager"""
-    secret_name = "grow-data-key"
-    region_name = "eu-west-1"
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            raise e
-    else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            secret = ast.literal_eval(secret)
-            return secret
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            return decoded_binary_secret
-        
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+import ast
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+# AWS Secrets Manager secret names
+AURORA_SECRET = 'grow-data-key'
+GROW_API_SECRET = 'grow-api'
+WOW_API_SECRET = 'wow-api'
+REGION_NAME = 'eu-west-1'
+# Seconds before a cached secret is fetched again
+SECRET_TTL = int(os.environ.get('GROW_SECRET_TTL', 3600))
+# Offline stand-ins for Secrets Manager: a JSON file of
+# {secret_name: secret}, or one GROW_SECRET_<NAME> environment
+# variable per secret, ie: GROW_SECRET_GROW_DATA_KEY
+SECRETS_FILE = os.environ.get('GROW_SECRETS_FILE')
+
+def parse_secret(secret: str):
+    """Secrets are stored as JSON or Python dict literals"""
+    try:
+        return json.loads(secret)
+    except ValueError:
+        return ast.literal_eval(secret)
+
+def local_secret(secret_name: str):
+    """Return the offline stand-in of a secret, None if there is none"""
+    env_name = 'GROW_SECRET_' + secret_name.upper().replace('-', '_')
+    if env_name in os.environ:
+        return parse_secret(os.environ[env_name])
+    if SECRETS_FILE is not None:
+        with open(SECRETS_FILE) as secrets_file:
+            return json.load(secrets_file).get(secret_name)
+    return None
+
+class SecretCache:
+    """Fetches secrets from AWS Secrets Manager concurrently, with one
+    shared client, and caches them for ttl seconds.
+    """
+
+    def __init__(self, ttl: int = SECRET_TTL) -> None:
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.client_lock = threading.Lock()
+        self.client = None
+        # (expires at, Future) of every fetched or in-flight secret
+        self.secrets = dict()
+
+    def _client(self):
+        with self.client_lock:
+            if self.client is None:
+                # boto3 is slow to import, only pay for it when it is used
+                import boto3
+                self.client = boto3.session.Session().client(service_name='secretsmanager',
+                                                            region_name=REGION_NAME)
+            return self.client
+
+    def _fetch(self, secret_name: str):
+        secret = local_secret(secret_name)
+        if secret is not None:
+            return secret
+        # ClientErrors (missing secret, no permission...) are raised to the caller
+        response = self._client().get_secret_value(SecretId=secret_name)
+        if 'SecretString' in response:
+            return parse_secret(response['SecretString'])
+        return base64.b64decode(response['SecretBinary'])
+
+    def get(self, secret_names: List[str]) -> Dict:
+        """Return {secret_name: secret}, fetching missing & expired
+        secrets at the same time. Secrets already being fetched by
+        another thread are waited for, not fetched again. The lock is
+        never held while fetching. A failed fetch is retried by the
+        next call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            missing = [x for x in dict.fromkeys(secret_names)
+                        if x not in self.secrets or now > self.secrets[x][0]]
+            for name in missing:
+                self.secrets[name] = (now + self.ttl, Future())
+            futures = {x: self.secrets[x][1] for x in secret_names}
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                fetches = [executor.submit(self._fetch, x) for x in missing]
+            for name, fetch in zip(missing, fetches):
+                if fetch.exception() is None:
+                    futures[name].set_result(fetch.result())
+                    continue
+                with self.lock:
+                    if self.secrets.get(name, (None, None))[1] is futures[name]:
+                        del self.secrets[name]
+                futures[name].set_exception(fetch.exception())
+        return {x: futures[x].result() for x in secret_names}
+
+secret_cache = SecretCache()
+
+def get_secrets(*secret_names: str) -> List:
+    """Return the secrets in the order they were asked for"""
+    secrets = secret_cache.get(list(secret_names))
+    return [secrets[x] for x in secret_names]
+
+def get_secret(secret_name: str):
+    """Return one secret, cached for SECRET_TTL seconds"""
+    return get_secrets(secret_name)[0]
+
+def prefetch_secrets(*secret_names: str) -> None:
+    """Start fetching secrets in the background at process start, so
+    they are cached by the time the first request needs them. Failed
+    secrets are fetched again by the first get_secrets call.
+    """
+    def prefetch() -> None:
+        try:
+            secret_cache.get(list(secret_names))
+        except Exception as error:
+            print('Secret prefetch error: ', error)
+    threading.Thread(target=prefetch, daemon=True).start()
+
+def aurora_creds_from_secret(aurora_secret: dict) -> dict:
+    """Convert the Aurora secret to psycopg2 connection arguments"""
+    return {
+        'host': aurora_secret['host'],
+        'port': aurora_secret['port'],
+        'dbname': aurora_secret['engine'],
+        'user': aurora_secret['username'],
+        'password': aurora_secret['password']
+    }
@@ -1,79 +1,89 @@
 #!/usr/bin/env python3
 
-import ast
 import argparse
-import base64
 import datetime
 from typing import List, Tuple
 
-import boto3
 import numpy as np
-import pandas as pd
-from botocore.exceptions import ClientError
-from keras.models import load_model
-from psycopg2 import sql
-from sklearn.preprocessing import MinMaxScaler
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine
 
-from use_postgres import UseDatabase
+from analyse_anomalies import refresh_sensor_health, update_days_since_anomaly
+from credentials import AURORA_SECRET, aurora_creds_from_secret, get_secret
+from inference_service import RemoteModel
+from use_postgres import UseDatabase, bump_data_version
 
-def get_grow_tables_to_analyse(aurora_creds: dict) -> np.ndarray:
+# Pre-screen thresholds, applied to MinMax scaled values in [0,1]
+PRESCREEN_MIN_STD = 0.01
+PRESCREEN_MAX_RUN = 8 # 8 observations = 2 hours of identical readings
+PRESCREEN_NORMAL = 'normal'
+PRESCREEN_FAULTY = 'faulty'
+PRESCREEN_AMBIGUOUS = 'ambiguous'
+# Analysed GROW tables whose anomalies are committed together, so a
+# failed run keeps the results of the batches before it
+ANOMALY_BATCH_TABLES = 50
+
+def get_grow_tables_to_analyse(aurora_creds: dict) -> List:
     """Return all GROW table names from AWS Aurora DB that have
     not been analysed, or GROW tables with new data that 
     has not yet been analysed.
     """
-    with UseDatabase(aurora_creds) as cursor:
-        # Fetch all grow data table names
-        sql_all = """SELECT table_name 
-                    FROM information_schema.tables 
-                    WHERE table_name 
-                    LIKE 'grow_data_%%';"""
-        cursor.execute(sql_all)
-        all_tables_array = cursor.fetchall()
-        grow_tables = []
-        for i in all_tables_array:
-            # Fetch most recent observation date recorded per grow table
-            sql_grow = sql.SQL("""SELECT CONCAT('grow_data_', sensor_id), datetime
-                                FROM {}
-                                WHERE datetime = (SELECT MAX(datetime) FROM {})
-                                """).format(sql.Identifier(i[0]),
-                                            sql.Identifier(i[0]))
-            cursor.execute(sql_grow)
-            result_array = cursor.fetchall()
-            grow_tables.append(result_array)
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        # Fetch most recent observation date per grow table from the 
+        # watermarks kept by extract_all_grow_data.py, restricted to
+        # grow tables that still exist
+        sql_grow = """SELECT w.grow_table, w.last_datetime
+                    FROM grow_watermarks w
+                    JOIN information_schema.tables t 
+                    ON t.table_name = w.grow_table;"""
+        cursor.execute(sql_grow)
+        grow_tables = cursor.fetchall()
         # Fetch most recently analysed grow table & date
         sql_anom = """SELECT grow_table, 
                         MAX(last_analysed) 
                 FROM public.grow_anomalies 
                 GROUP BY grow_table;"""
         cursor.execute(sql_anom)
-        anom_tables_array = cursor.fetchall()
-        # Find grow tables that have not been analysed yet, and 
-        # grow tables that have new data that needs to be analysed
-        tables_to_analyse = []
-        for i in grow_tables:
-            # If grow table has not been analysed yet
-            if i[0][0] not in [x[0] for x in anom_tables_array]:
-                tables_to_analyse.append(i[0][0])
-                continue
-            for tab in anom_tables_array:
-                # If grow table has more recent data than that already analysed
-                if i[0][0] == tab[0] and i[0][1] > tab[1]:
-                    tables_to_analyse.append(i[0][0])
+        last_analysed = dict(cursor.fetchall())
+    # Find grow tables that have not been analysed yet, and 
+    # grow tables that have new data that needs to be analysed
+    tables_to_analyse = []
+    for grow_table, last_datetime in grow_tables:
+        analysed = last_analysed.get(grow_table)
+        if analysed is None or (last_datetime is not None and last_datetime > analysed):
+            tables_to_analyse.append(grow_table)
     return tables_to_analyse
 
 def get_keras_models() -> '3 Keras Models':
     """Retrieve previously trained Keras models for anomaly detection"""
+    from keras.models import load_model
     soil_model = load_model('soil_model.h5')
     light_model = load_model('light_model.h5')
     air_model = load_model('air_model.h5')
     return soil_model, light_model, air_model
 
+def get_joint_model() -> 'Keras Model':
+    """Retrieve previously trained joint soil/light/air Keras model"""
+    from keras.models import load_model
+    return load_model('joint_model.h5')
+
+def get_service_models(service_url: str, joint: bool) -> Tuple:
+    """Use the models kept loaded by inference_service.py instead of 
+    importing Keras and loading the models in this process
+    """
+    if joint:
+        return (RemoteModel(service_url, 'joint'),)
+    return RemoteModel(service_url, 'soil'), RemoteModel(service_url, 'light'), \
+            RemoteModel(service_url, 'air')
+
 def predict_df_length_check(table_name: str, conn):
     """Retrieve GROW data from GROW table, convert it 
     to a DataFrame divisible by 96. Declare whether the
     DataFrame has over 96 observations.
     """
+    # pandas, scikit-learn & Keras are only imported once there
+    # is a table to analyse
+    import pandas as pd
     sql_select = f"""SELECT * FROM {table_name}"""
     analyse_datetime = datetime.datetime.now()
     df = pd.read_sql(sql_select, conn, parse_dates=['datetime'])
@@ -91,12 +101,13 @@ def predict_df_length_check(table_name: str, conn):
         empty_df = False
         return predict_df, analyse_datetime, empty_df
 
-def construct_predict_dfs(predict_df: pd.DataFrame) -> Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame,np.ndarray]:
+def construct_predict_dfs(predict_df: 'DataFrame') -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.ndarray]:
     """Construct 3 DataFrames and one Numpy array from the contents of 
     previously created DataFrame. These DataFrames will be 
     analysed against the Keras models previously built to 
     detect anomalies/anomalous data.
     """
+    from sklearn.preprocessing import MinMaxScaler
     predict_df_2 = predict_df.copy(deep=True)
     predict_df_3 = predict_df.copy(deep=True)
     predict_df_4 = predict_df.copy(deep=True)
@@ -138,20 +149,117 @@ def construct_predict_dfs(predict_df: pd.DataFrame) -> Tuple[pd.DataFrame,pd.Dat
     return predict_df_soil_scaled, predict_df_light_scaled, \
             predict_df_air_scaled, predict_dates_array
 
-def predict_on_keras_models(predict_soil_df: pd.DataFrame, predict_light_df: pd.DataFrame, 
-                            predict_air_df: pd.DataFrame, soil_model, 
-                            light_model, air_model) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
-    """Uses the provided DataFrames to predict on the previously built Keras models.
-    Calculates and returns their reconstruction error to later detect anomalous data.
+def longest_repeat_runs(windows: np.ndarray) -> np.ndarray:
+    """Return the longest run of identical consecutive observations
+    in each day (row) of a 2D array of shape (days, 96).
+    """
+    same = (windows[:, 1:] == windows[:, :-1]).astype(np.int8)
+    padded = np.zeros((same.shape[0], same.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = same
+    edges = np.diff(padded, axis=1)
+    starts = np.argwhere(edges == 1)
+    ends = np.argwhere(edges == -1)
+    longest = np.zeros(windows.shape[0], dtype=np.int64)
+    # argwhere is row-major, so the n-th start pairs with the n-th end
+    np.maximum.at(longest, starts[:, 0], ends[:, 1] - starts[:, 1])
+    # A run of n identical pairs is n + 1 identical observations
+    return np.where(longest > 0, longest + 1, 1)
+
+def prescreen_days(predict_variable: np.ndarray) -> np.ndarray:
+    """Classify each day of one GROW variable as clearly normal,
+    clearly faulty or ambiguous with cheap vectorized statistics,
+    so only ambiguous days need to be passed to the Keras model.
+    A day is faulty when it has gaps, or it is a flatline identical
+    to the following day (the model would then reconstruct both days
+    with identical error, which analyse_*_error flags anyway).
+    A day is normal when it varies, has no stuck runs and differs
+    from both neighbouring days.
+    """
+    windows = predict_variable.reshape(predict_variable.shape[0], -1)
+    paths = np.full(windows.shape[0], PRESCREEN_AMBIGUOUS, dtype=object)
+    if windows.shape[0] == 0:
+        return paths
+    gaps = np.isnan(windows).any(axis=1)
+    std = np.std(np.nan_to_num(windows), axis=1)
+    longest_runs = longest_repeat_runs(windows)
+    same_as_next = np.zeros(windows.shape[0], dtype=bool)
+    same_as_next[:-1] = (windows[:-1] == windows[1:]).all(axis=1)
+    same_as_previous = np.zeros(windows.shape[0], dtype=bool)
+    same_as_previous[1:] = same_as_next[:-1]
+    faulty = gaps | ((std == 0) & same_as_next)
+    normal = ~gaps & (std >= PRESCREEN_MIN_STD) \
+                & (longest_runs < PRESCREEN_MAX_RUN) \
+                & ~same_as_next & ~same_as_previous
+    paths[normal] = PRESCREEN_NORMAL
+    paths[faulty] = PRESCREEN_FAULTY
+    return paths
+
+def predict_ambiguous_days(predict_variable: np.ndarray, paths: np.ndarray, model) -> np.ndarray:
+    """Predict only the ambiguous days on the provided Keras model.
+    Returns the reconstruction error with the same shape as a full 
+    prediction; days that skipped the model are NaN, so they never 
+    match a neighbouring day in analyse_*_error.
+    """
+    mse = np.full((predict_variable.shape[0], predict_variable.shape[2]), np.nan)
+    ambiguous = paths == PRESCREEN_AMBIGUOUS
+    if ambiguous.any():
+        predictions = model.predict(predict_variable[ambiguous])
+        mse[ambiguous] = np.mean(np.power(predict_variable[ambiguous] - predictions, 2), axis=1)
+    return mse
+
+def predict_ambiguous_days_joint(predict_soil: np.ndarray, predict_light: np.ndarray,
+                                predict_air: np.ndarray, soil_paths: np.ndarray,
+                                light_paths: np.ndarray, air_paths: np.ndarray,
+                                joint_model) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """Predict days that are ambiguous for any variable on the joint
+    Keras model, one forward pass per day for all three variables.
+    Returns the per-variable reconstruction errors, NaN for every
+    variable whose day was settled by the pre-screen.
     """
-    predictions_soil = soil_model.predict(predict_soil_df)
-    # Mean-squared error: Reconstruction error
-    mse_soil = np.mean(np.power(predict_soil_df - predictions_soil, 2), axis=1)
-    predictions_light = light_model.predict(predict_light_df)
-    mse_light = np.mean(np.power(predict_light_df - predictions_light, 2), axis=1)
-    predictions_air = air_model.predict(predict_air_df)
-    mse_air = np.mean(np.power(predict_air_df - predictions_air, 2), axis=1)
-    return mse_soil, mse_light, mse_air
+    predict_joint = np.concatenate([predict_soil, predict_light, predict_air], axis=2)
+    mse = np.full((predict_joint.shape[0], 3), np.nan)
+    ambiguous = np.stack([soil_paths, light_paths, air_paths], axis=1) == PRESCREEN_AMBIGUOUS
+    days = ambiguous.any(axis=1)
+    if days.any():
+        predictions = joint_model.predict(predict_joint[days])
+        mse[days] = np.mean(np.power(predict_joint[days] - predictions, 2), axis=1)
+    mse[~ambiguous] = np.nan
+    return mse[:, 0:1], mse[:, 1:2], mse[:, 2:3]
+
+def prescreen_anomalies(paths: np.ndarray, predict_dates: np.ndarray) -> List:
+    """Record the days the pre-screen classified as faulty in the 
+    same [error, datetime] format as analyse_*_error. The
+    reconstruction error of these days was never computed.
+    """
+    anomalous_results = []
+    for index in np.flatnonzero(paths == PRESCREEN_FAULTY):
+        anomalous_results.append([np.nan, predict_dates[index][0][0]])
+    return anomalous_results
+
+def merge_anomalies(model_anomalies: List, prescreen_results: List) -> List:
+    """Combine model and pre-screen anomalies, ordered by datetime"""
+    return sorted(model_anomalies + prescreen_results, key=lambda x: x[1])
+
+def store_prescreen_paths(table_name: str, predict_dates: np.ndarray, soil_paths: np.ndarray, 
+                        light_paths: np.ndarray, air_paths: np.ndarray, 
+                        analyse_datetime: str, conn) -> None:
+    """Record which path (normal, faulty, ambiguous) each day of each
+    GROW variable took through the pre-screen, so the share of days
+    that skipped model inference can be measured per run. The rows of
+    the latest run replace the table's previous ones.
+    """
+    import pandas as pd
+    paths_df = pd.DataFrame({'grow_table': table_name,
+                            'day': [x[0][0] for x in predict_dates],
+                            'soil_path': soil_paths,
+                            'light_path': light_paths,
+                            'air_path': air_paths,
+                            'last_analysed': analyse_datetime})
+    # Every run re-analyses the whole GROW table
+    with conn.begin() as transaction:
+        transaction.execute("""DELETE FROM grow_prescreen
+                            WHERE grow_table = %s""", (table_name,))
+        paths_df.to_sql('grow_prescreen', transaction, if_exists='append', index=False)
 
 def analyse_soil_error(mse_soil: np.ndarray, predict_dates: np.ndarray) -> List:
     """Loop through soil reconsruction error array. If error is 
@@ -195,116 +303,127 @@ def create_anomaly_table(conn) -> None:
             soil_date timestamp, 
             light_date timestamp, 
             air_date timestamp,
-            last_analysed timestamp
+            last_analysed timestamp,
+            days_since_anomaly integer
             )"""
     conn.execute(sql_create)
 
-def insert_anomalies(soil_anomalies: List, light_anomalies: List,
-                    air_anomalies: List, table_name: str,
-                    aurora_creds: dict, analyse_datetime: str) -> None:
-    """Insert anomalous datetimes into AWS Aurora grow_anomalies table"""
-    with UseDatabase(aurora_creds) as cursor:
-        # If grow sensor table is already in grow_anomalies, delete the rows
-        # so fresh data can be inserted in its place
-        sql_check = sql.SQL("""SELECT * FROM grow_anomalies
-                            WHERE grow_table = {}
-                            LIMIT 1;""").format(sql.Literal(table_name))
-        cursor.execute(sql_check)
-        results = cursor.fetchall()
-        if results:
-            sql_delete = sql.SQL("""DELETE FROM grow_anomalies
-                                WHERE grow_table = {}""").format(sql.Literal(table_name))
-            cursor.execute(sql_delete)
-        for anom in soil_anomalies:
-            sql_insert = sql.SQL("""INSERT INTO grow_anomalies
-                            (grow_table, soil_date, last_analysed)
-                            VALUES({},{},{})""") \
-                            .format(sql.Literal(table_name),
-                                    sql.Literal(str(anom[1])),
-                                    sql.Literal(analyse_datetime))
-            cursor.execute(sql_insert)
-        for anom in light_anomalies:
-            sql_insert = sql.SQL("""INSERT INTO grow_anomalies
-                            (grow_table, light_date, last_analysed)
-                            VALUES({},{},{})""") \
-                            .format(sql.Literal(table_name),
-                                    sql.Literal(str(anom[1])),
-                                    sql.Literal(analyse_datetime))
-            cursor.execute(sql_insert)
-        for anom in air_anomalies:
-            sql_insert = sql.SQL("""INSERT INTO grow_anomalies
-                            (grow_table, air_date, last_analysed)
-                            VALUES({},{},{})""") \
-                            .format(sql.Literal(table_name),
-                                    sql.Literal(str(anom[1])),
-                                    sql.Literal(analyse_datetime))
-            cursor.execute(sql_insert)
+def create_prescreen_table(conn) -> None:
+    """Create table to store the pre-screen path of every
+    analysed day in AWS Aurora instance, one row per GROW table & day
+    """
+    sql_create = """CREATE TABLE IF NOT EXISTS grow_prescreen(
+            grow_table varchar(18),
+            day timestamp,
+            soil_path varchar(9),
+            light_path varchar(9),
+            air_path varchar(9),
+            last_analysed timestamp,
+            PRIMARY KEY (grow_table, day)
+            )"""
+    conn.execute(sql_create)
 
-def get_aurora_secret():
-    """Retrieve AWS RDS Aurora credentials from AWS Secrets Manager"""
-    secret_name = "grow-data-key"
-    region_name = "eu-west-1"
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            raise e
-    else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            secret = ast.literal_eval(secret)
-            return secret
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            return decoded_binary_secret
+def anomaly_rows(soil_anomalies: List, light_anomalies: List,
+                air_anomalies: List, table_name: str,
+                analyse_datetime: str) -> List:
+    """Convert the anomalies of one GROW table to grow_anomalies rows"""
+    rows = []
+    for anom in soil_anomalies:
+        rows.append((table_name, str(anom[1]), None, None, analyse_datetime))
+    for anom in light_anomalies:
+        rows.append((table_name, None, str(anom[1]), None, analyse_datetime))
+    for anom in air_anomalies:
+        rows.append((table_name, None, None, str(anom[1]), analyse_datetime))
+    return rows
+
+def insert_anomalies(rows: List, analysed_tables: List, aurora_creds: dict) -> None:
+    """Insert anomalous datetimes of a batch of analysed GROW tables
+    into AWS Aurora grow_anomalies table in one transaction, then
+    update days_since_anomaly and sensor_health for all GROW tables.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        # Delete the rows of every analysed grow table so fresh data 
+        # can be inserted in its place
+        cursor.execute("""DELETE FROM grow_anomalies
+                        WHERE grow_table = ANY(%s)""", (analysed_tables,))
+        execute_values(cursor, """INSERT INTO grow_anomalies
+                        (grow_table, soil_date, light_date, air_date, last_analysed)
+                        VALUES %s""", rows, page_size=1000)
+        update_days_since_anomaly(cursor)
+        refresh_sensor_health(cursor)
+        bump_data_version(cursor)
 
-def main():
+def main(joint: bool = False, service_url: str = None):
     """Scans through all GROW data to find anomalies. 
     Stores anomalous findings (datetimes of anomalies)
-    in AWS Aurora 'grow_anomalies' table.
+    in AWS Aurora 'grow_anomalies' table, committed every
+    ANOMALY_BATCH_TABLES tables, and updates days_since_anomaly
+    for every GROW table. If joint is True,
+    the joint soil/light/air model is used instead of the
+    three single variable models. If service_url is given, 
+    predictions are made by the warm inference service.
     """
-    aurora_secret = get_aurora_secret()
-    aurora_creds = {
-        'host': aurora_secret['host'],
-        'port': aurora_secret['port'],
-        'dbname': aurora_secret['engine'],
-        'user': aurora_secret['username'],
-        'password': aurora_secret['password']
-    }
+    aurora_secret = get_secret(AURORA_SECRET)
+    aurora_creds = aurora_creds_from_secret(aurora_secret)
     conn = create_engine(f"postgresql+psycopg2://{aurora_secret['username']}:{aurora_secret['password']}@{aurora_secret['host']}/{aurora_secret['engine']}")
 
     tables_to_analyse = get_grow_tables_to_analyse(aurora_creds)
-    soil_model, light_model, air_model = get_keras_models()
+    # Only pay for loading Keras models when there is something new to analyse
+    if tables_to_analyse:
+        if service_url and joint:
+            joint_model, = get_service_models(service_url, joint)
+        elif service_url:
+            soil_model, light_model, air_model = get_service_models(service_url, joint)
+        elif joint:
+            joint_model = get_joint_model()
+        else:
+            soil_model, light_model, air_model = get_keras_models()
+    create_anomaly_table(conn)
+    create_prescreen_table(conn)
+    all_anomaly_rows = []
+    analysed_tables = []
     for table in tables_to_analyse:
         predict_df, analyse_datetime, empty_df = predict_df_length_check(table, conn)
         if empty_df == True:
             continue
         predict_soil, predict_light, predict_air, predict_dates = construct_predict_dfs(predict_df)
-        mse_soil, mse_light, mse_air = predict_on_keras_models(predict_soil, predict_light, predict_air,
-                                                                soil_model, light_model, air_model)
-        anomalous_soil = analyse_soil_error(mse_soil, predict_dates)
-        anomalous_light = analyse_light_error(mse_light, predict_dates)
-        anomalous_air = analyse_air_error(mse_air, predict_dates)
-        create_anomaly_table(conn)
-        insert_anomalies(anomalous_soil, anomalous_light, anomalous_air, table,
-                        aurora_creds, analyse_datetime)
+        # Cheap statistical pre-screen, only ambiguous days reach the models
+        soil_paths = prescreen_days(predict_soil)
+        light_paths = prescreen_days(predict_light)
+        air_paths = prescreen_days(predict_air)
+        if joint:
+            mse_soil, mse_light, mse_air = predict_ambiguous_days_joint(predict_soil, predict_light,
+                                                                        predict_air, soil_paths,
+                                                                        light_paths, air_paths,
+                                                                        joint_model)
+        else:
+            mse_soil = predict_ambiguous_days(predict_soil, soil_paths, soil_model)
+            mse_light = predict_ambiguous_days(predict_light, light_paths, light_model)
+            mse_air = predict_ambiguous_days(predict_air, air_paths, air_model)
+        anomalous_soil = merge_anomalies(analyse_soil_error(mse_soil, predict_dates),
+                                        prescreen_anomalies(soil_paths, predict_dates))
+        anomalous_light = merge_anomalies(analyse_light_error(mse_light, predict_dates),
+                                        prescreen_anomalies(light_paths, predict_dates))
+        anomalous_air = merge_anomalies(analyse_air_error(mse_air, predict_dates),
+                                        prescreen_anomalies(air_paths, predict_dates))
+        store_prescreen_paths(table, predict_dates, soil_paths, light_paths, air_paths,
+                            analyse_datetime, conn)
+        all_anomaly_rows.extend(anomaly_rows(anomalous_soil, anomalous_light, anomalous_air,
+                                            table, analyse_datetime))
+        analysed_tables.append(table)
+        if len(analysed_tables) == ANOMALY_BATCH_TABLES:
+            insert_anomalies(all_anomaly_rows, analysed_tables, aurora_creds)
+            all_anomaly_rows = []
+            analysed_tables = []
+    # Also run with no tables left, sensor_health picks up new sensors
+    insert_anomalies(all_anomaly_rows, analysed_tables, aurora_creds)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--joint', action='store_true',
+                        help='use the joint soil/light/air model (joint_model.h5)')
+    parser.add_argument('--service', dest='service_url', default=None,
+                        help='inference_service.py URL, ie: http://127.0.0.1:8500')
+    args = parser.parse_args()
+    main(args.joint, args.service_url)
 
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib import request as urllib_request
+
+import numpy as np
+
+# Models kept loaded by the service, joint_model.h5 is optional
+MODEL_FILES = {'soil': 'soil_model.h5',
+                'light': 'light_model.h5',
+                'air': 'air_model.h5',
+                'joint': 'joint_model.h5'}
+
+class LatencyMetrics:
+    """Thread-safe request latency and batch size statistics
+    over the most recent requests.
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.windows = 0
+        self.batches = 0
+
+    def record_request(self, seconds: float, windows: int) -> None:
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.windows += windows
+
+    def record_batch(self, requests: int) -> None:
+        with self.lock:
+            self.batch_sizes.append(requests)
+            self.batches += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            summary = {'requests': self.requests,
+                        'windows': self.windows,
+                        'batches': self.batches}
+        if len(latencies):
+            summary['latency_ms'] = {'p50': float(np.percentile(latencies, 50)),
+                                    'p95': float(np.percentile(latencies, 95)),
+                                    'p99': float(np.percentile(latencies, 99)),
+                                    'max': float(latencies.max())}
+            summary['mean_requests_per_batch'] = float(batch_sizes.mean())
+        return summary
+
+class MicroBatcher:
+    """Owns the Keras models and runs every prediction on a single
+    worker thread. Concurrent requests for the same model that arrive
+    within max_wait seconds are concatenated into one predict call.
+    """
+
+    def __init__(self, model_files: Dict[str, str], max_batch_windows: int = 4096,
+                max_wait: float = 0.01) -> None:
+        self.model_files = model_files
+        self.max_batch_windows = max_batch_windows
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        # Requests taken off the queue for another model's batch, served
+        # before the queue in arrival order. Only used by the worker thread
+        self.deferred = deque()
+        self.metrics = {name: LatencyMetrics() for name in model_files}
+        self.models = {}
+        self.load_error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.load_error is not None:
+            raise self.load_error
+
+    def _load_models(self) -> None:
+        """Load the models on the worker thread that will use them"""
+        from keras.models import load_model
+        for name, path in self.model_files.items():
+            try:
+                self.models[name] = load_model(path)
+            except (IOError, OSError):
+                if name != 'joint':
+                    raise
+                print(f'{path} not found, joint model disabled')
+
+    def predict(self, name: str, windows: np.ndarray) -> np.ndarray:
+        """Queue windows for the named model and wait for the predictions"""
+        if name not in self.models:
+            raise KeyError(name)
+        start = time.monotonic()
+        item = {'name': name, 'windows': windows, 'done': threading.Event()}
+        self.queue.put(item)
+        item['done'].wait()
+        self.metrics[name].record_request(time.monotonic() - start, len(windows))
+        if 'error' in item:
+            raise item['error']
+        return item['predictions']
+
+    def _collect_batch(self, first: dict) -> List[dict]:
+        """Collect further requests for the same model until the batch
+        is full or max_wait has passed. Requests for other models are
+        deferred, keeping their order ahead of the queue.
+        """
+        batch = [first]
+        size = len(first['windows'])
+        others = deque()
+        while self.deferred:
+            item = self.deferred.popleft()
+            if item['name'] == first['name'] and size < self.max_batch_windows:
+                batch.append(item)
+                size += len(item['windows'])
+            else:
+                others.append(item)
+        self.deferred = others
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_windows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item['name'] == first['name']:
+                batch.append(item)
+                size += len(item['windows'])
+            else:
+                self.deferred.append(item)
+        return batch
+
+    def _run(self) -> None:
+        try:
+            self._load_models()
+        except Exception as error:
+            self.load_error = error
+            return
+        finally:
+            self.ready.set()
+        while True:
+            first = self.deferred.popleft() if self.deferred else self.queue.get()
+            batch = self._collect_batch(first)
+            name = batch[0]['name']
+            try:
+                windows = np.concatenate([x['windows'] for x in batch])
+                predictions = self.models[name].predict(windows)
+                offsets = np.cumsum([len(x['windows']) for x in batch])[:-1]
+                for item, result in zip(batch, np.split(predictions, offsets)):
+                    item['predictions'] = result
+            except Exception as error:
+                for item in batch:
+                    item['error'] = error
+            self.metrics[name].record_batch(len(batch))
+            for item in batch:
+                item['done'].set()
+
+def make_handler(batcher: MicroBatcher) -> 'RequestHandler':
+    """Create HTTP request handler class bound to the batcher"""
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status: int, body: dict) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self) -> None:
+            if self.path == '/metrics':
+                self._send_json(200, {name: metrics.summary()
+                                    for name, metrics in batcher.metrics.items()
+                                    if name in batcher.models})
+            elif self.path == '/health':
+                self._send_json(200, {'models': sorted(batcher.models)})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self) -> None:
+            """Accepts {"model": name, "windows": [...]} with windows shaped
+            (days, 96, dim), returns the model reconstructions.
+            """
+            if self.path != '/predict':
+                self._send_json(404, {'error': 'not found'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length))
+                windows = np.array(body['windows'], dtype=np.float32)
+                predictions = batcher.predict(body['model'], windows)
+            except KeyError as error:
+                self._send_json(400, {'error': f'unknown field or model {error}'})
+                return
+            except Exception as error:
+                self._send_json(500, {'error': str(error)})
+                return
+            self._send_json(200, {'predictions': predictions.tolist()})
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return RequestHandler
+
+class RemoteModel:
+    """Stand-in for a Keras model that predicts through the warm
+    inference service, so callers such as detect_anomalies.py do not
+    import TensorFlow or load the models themselves.
+    """
+
+    def __init__(self, url: str, name: str) -> None:
+        self.url = url.rstrip('/')
+        self.name = name
+
+    def predict(self, windows: np.ndarray) -> np.ndarray:
+        payload = json.dumps({'model': self.name,
+                            'windows': np.asarray(windows).tolist()}).encode()
+        req = urllib_request.Request(f'{self.url}/predict', data=payload,
+                                    headers={'Content-Type': 'application/json'})
+        with urllib_request.urlopen(req) as response:
+            body = json.loads(response.read())
+        return np.array(body['predictions'])
+
+def main(host: str, port: int, max_batch_windows: int, max_wait_ms: float):
+    """Loads the anomaly detection models once and serves predictions
+    over local HTTP until stopped.
+    """
+    batcher = MicroBatcher(MODEL_FILES, max_batch_windows, max_wait_ms / 1000)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f'Serving {sorted(batcher.models)} on http://{host}:{port}')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--max-batch-windows', type=int, default=4096)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    args = parser.parse_args()
+    main(args.host, args.port, args.max_batch_windows, args.max_wait_ms)
@@ -1,27 +1,31 @@
 #!/usr/bin/env python3
 
-import ast
-import base64
-import datetime
-from typing import Tuple
-
-import boto3
-import keras
-import matplotlib.pyplot as plt
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
 import numpy as np
-import pandas as pd
-import tensorflow as tf
-from botocore.exceptions import ClientError
-from keras.models import Model, Sequential, load_model
-from keras.layers import Input, Dense, LSTM
-from sklearn.preprocessing import  StandardScaler, MinMaxScaler
-from sklearn.model_selection import train_test_split
 from sqlalchemy import create_engine
 
-def create_training_dataframes(conn) -> Tuple[pd.DataFrame,pd.DataFrame,pd.DataFrame]:
+from credentials import AURORA_SECRET, get_secret
+
+MODEL_DIR = 'saved_models'
+CHECKPOINT_DIR = 'saved_models/checkpoints'
+WINDOW_DIR = 'saved_models/windows'
+# Keras/TensorFlow, pandas & scikit-learn are imported by the functions
+# using them: the parent process only prepares data and never loads
+# TensorFlow, each spawned training worker loads it once.
+
+def create_training_dataframes(conn) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
     """Create DataFrames to be passed into the neural network 
     models for training.
     """
+    import pandas as pd
+    from sklearn.preprocessing import MinMaxScaler
     # Tables that have been identified as producing only normal data
     good_tables = ['grow_data_5pga25ec','grow_data_5pga25ec','grow_data_5kc81f8r','grow_data_02krq5q5','grow_data_0srkxe23']
 
@@ -74,141 +78,218 @@ def create_training_dataframes(conn) -> Tuple[pd.DataFrame,pd.DataFrame,pd.DataF
     
     return new_df_soil_scaled, new_df_light_scaled, new_df_air_scaled
 
-def create_models() -> Tuple[Model, Model, Model]:
-    """Create LSTM Autoencoder neural network models with Keras."""
+def create_model(dim: int = 1) -> 'Keras Model':
+    """Create one LSTM Autoencoder neural network model with Keras
+    for dim GROW variables.
+    """
+    from keras.layers import Dense, LSTM
+    from keras.models import Sequential
     timesteps = 96
-    dim = 1
-    # Create LSTM Autoencoder neural network for soil moisture
-    model_soil = Sequential()
-    model_soil.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_soil.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_soil.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_soil.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_soil.add(Dense(1))
-    model_soil.compile(loss='mse', optimizer='adam') # starts and finishes with less val_loss & loss
+    model = Sequential()
+    model.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
+    model.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
+    model.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
+    model.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
+    model.add(Dense(dim))
+    model.compile(loss='mse', optimizer='adam') # starts and finishes with less val_loss & loss
     # model.compile(loss='mae', optimizer='adam') # compared to mae loss parameter
     # prediction mse is slightly less with 'mse' loss parameter
     ########
     # model & predictions performed MUCH better when the train&test datasets were
     # divisible by 96 and there was no observation gap between them
+    return model
+
+def create_joint_training_array(soil_df: np.ndarray, light_df: np.ndarray,
+                                air_df: np.ndarray) -> np.ndarray:
+    """Stack the scaled soil, light and air temperature windows into 
+    one array of shape (days, 96, 3) for the joint autoencoder.
+    Channel order is soil, light, air.
+    """
+    return np.concatenate([soil_df, light_df, air_df], axis=2)
+
+def save_training_windows(windows: Dict[str, np.ndarray]) -> Dict[str, str]:
+    """Save each training array to WINDOW_DIR so training workers
+    can stream batches from a memory map instead of receiving a copy.
+    """
+    os.makedirs(WINDOW_DIR, exist_ok=True)
+    window_paths = {}
+    for name, array in windows.items():
+        window_paths[name] = os.path.join(WINDOW_DIR, f'{name}_windows.npy')
+        np.save(window_paths[name], array)
+    return window_paths
+
+def window_generator(windows_path: str, start: int, stop: int,
+                    batch_size: int, shuffle: bool = True) -> Iterator:
+    """Endlessly yield (input, target) batches of windows[start:stop]
+    read from a memory mapped .npy file.
+    """
+    windows = np.load(windows_path, mmap_mode='r')
+    indices = np.arange(start, stop)
+    while True:
+        if shuffle:
+            np.random.shuffle(indices)
+        for i in range(0, len(indices), batch_size):
+            batch = np.asarray(windows[np.sort(indices[i:i + batch_size])])
+            yield batch, batch
+
+def logged_val_losses(name: str) -> List[float]:
+    """Return the validation loss of every epoch logged for an
+    interrupted training run.
+    """
+    history_path = os.path.join(CHECKPOINT_DIR, f'{name}_history.csv')
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, newline='') as history:
+        return [float(x['val_loss']) for x in csv.DictReader(history)]
+
+def get_training_callbacks(name: str, val_losses: List[float]) -> List:
+    """Stop early on validation loss, checkpoint every epoch & the best
+    epoch and log the history so an interrupted run can resume.
+    Early stopping & the best checkpoint carry on from the logged
+    val_losses of the interrupted run instead of starting over.
+    """
+    from keras.callbacks import CSVLogger, EarlyStopping, ModelCheckpoint
+    best = min(val_losses, default=np.inf)
+    wait = len(val_losses) - 1 - val_losses.index(best) if val_losses else 0
+
+    class ResumedEarlyStopping(EarlyStopping):
+        def on_train_begin(self, logs=None):
+            super().on_train_begin(logs)
+            self.best = best
+            self.wait = wait
 
-    # Create LSTM Autoencoder neural network for light
-    model_light = Sequential()
-    model_light.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_light.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_light.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_light.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_light.add(Dense(1))
-    model_light.compile(loss='mse', optimizer='adam')
-
-    # Create LSTM Autoencoder neural network for air temperature
-    model_air = Sequential()
-    model_air.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_air.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_air.add(LSTM(25,input_shape=(timesteps,dim),return_sequences=True))
-    model_air.add(LSTM(50,input_shape=(timesteps,dim),return_sequences=True))
-    model_air.add(Dense(1))
-    model_air.compile(loss='mse', optimizer='adam')
-    return model_soil, model_light, model_air
-
-def train_models(soil_df: pd.DataFrame, light_df: pd.DataFrame,
-                air_df: pd.DataFrame, model_soil,
-                model_light, model_air):
-    """Trains the neural networks models with the previously created
-    DataFrames. Save models to local directory.
-    """    
+    best_checkpoint = ModelCheckpoint(os.path.join(CHECKPOINT_DIR, f'{name}_best.h5'),
+                                    monitor='val_loss', save_best_only=True)
+    best_checkpoint.best = best
+    return [ResumedEarlyStopping(monitor='val_loss', patience=10),
+            ModelCheckpoint(os.path.join(CHECKPOINT_DIR, f'{name}_model.h5')),
+            best_checkpoint,
+            CSVLogger(os.path.join(CHECKPOINT_DIR, f'{name}_history.csv'), append=True)]
+
+def limit_threads(threads: int) -> None:
+    """Limit TensorFlow to threads CPU threads in this process"""
+    import keras
+    import tensorflow as tf
+    if hasattr(tf, 'config') and hasattr(tf.config, 'threading'):
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    else:
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                inter_op_parallelism_threads=1)
+        keras.backend.set_session(tf.Session(config=config))
+
+def train_model_worker(name: str, windows_path: str, threads: int) -> str:
+    """Train one model (soil, light, air or joint) from streamed windows,
+    resuming from its checkpoint if a previous run was interrupted.
+    Save model to local directory and return its path.
+    """
+    from keras.models import load_model
+    limit_threads(threads)
     nb_epoch = 100
     batch_size = 32
-
-    # Train model on soil moisture data
-    start_time = datetime.datetime.now()
-    history_soil = model_soil.fit(soil_df, soil_df,
-                            epochs=nb_epoch,
-                            batch_size=batch_size,
-                            shuffle=True,
-                            validation_split=0.1,
-                            verbose=0
-                            )
-    end_time = datetime.datetime.now()
-    df_history_soil = pd.DataFrame(history_soil.history)
-
-    # Train model on light data
-    start_time = datetime.datetime.now()
-    history_light = model_light.fit(light_df, light_df,
-                            epochs=nb_epoch,
-                            batch_size=batch_size,
-                            shuffle=True,
-                            validation_split=0.1,
-                            verbose=0
-                            )
-    end_time = datetime.datetime.now()
-    df_history_light = pd.DataFrame(history_light.history)
-
-    # Train model on air temperature data
-    start_time = datetime.datetime.now()
-    history_air = model_air.fit(air_df, air_df,
-                            epochs=nb_epoch,
-                            batch_size=batch_size,
-                            shuffle=True,
-                            validation_split=0.1,
-                            verbose=0
-                            )
-    end_time = datetime.datetime.now()
-    df_history_air = pd.DataFrame(history_air.history)
-
-    # Save the models locally
-    model_soil.save('saved_models/soil_model.h5')
-    model_light.save('saved_models/light_model.h5')
-    model_air.save('saved_models/air_model.h5')
-
-def get_aurora_secret():
-    """Retrieve AWS RDS Aurora credentials from AWS Secrets Manager"""
-    secret_name = "grow-data-key"
-    region_name = "eu-west-1"
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            raise e
+    validation_split = 0.1
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    checkpoint_path = os.path.join(CHECKPOINT_DIR, f'{name}_model.h5')
+    best_path = os.path.join(CHECKPOINT_DIR, f'{name}_best.h5')
+    history_path = os.path.join(CHECKPOINT_DIR, f'{name}_history.csv')
+    val_losses = logged_val_losses(name)
+    if val_losses and os.path.exists(checkpoint_path) and os.path.exists(best_path):
+        model = load_model(checkpoint_path)
     else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-            secret = ast.literal_eval(secret)
-            return secret
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            return decoded_binary_secret
-
-def main():
-    """Creates training data and Keras neural network models. Trains the models
-    using training DataFrames, then saves the trained models to a local directory.
+        val_losses = []
+        for path in [checkpoint_path, best_path, history_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        model = create_model(dim=np.load(windows_path, mmap_mode='r').shape[2])
+    samples = len(np.load(windows_path, mmap_mode='r'))
+    split = int(samples * (1 - validation_split))
+    model.fit_generator(window_generator(windows_path, 0, split, batch_size),
+                        steps_per_epoch=math.ceil(split / batch_size),
+                        epochs=nb_epoch,
+                        initial_epoch=len(val_losses),
+                        validation_data=window_generator(windows_path, split, samples,
+                                                        batch_size, shuffle=False),
+                        validation_steps=math.ceil((samples - split) / batch_size),
+                        callbacks=get_training_callbacks(name, val_losses),
+                        verbose=0
+                        )
+    # Keep the best epoch of all runs, not the weights training stopped at.
+    # The best checkpoint is missing if no epoch improved val_loss (ie: NaN),
+    # the weights in memory are the latest ones then
+    if os.path.exists(best_path):
+        model = load_model(best_path)
+    model_path = os.path.join(MODEL_DIR, f'{name}_model.h5')
+    model.save(model_path)
+    # Training finished, the next run starts from scratch
+    for path in [checkpoint_path, best_path, history_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    return model_path
+
+def train_models(window_paths: Dict[str, str], workers: int = None) -> Dict[str, str]:
+    """Trains the neural network models in parallel worker processes,
+    splitting the CPU threads between them. Returns the saved model paths.
+    """
+    workers = workers or len(window_paths)
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    # Inherited by the spawned workers before they import numpy/TensorFlow
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    model_paths = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {name: executor.submit(train_model_worker, name, path, threads)
+                    for name, path in window_paths.items()}
+        for name, future in futures.items():
+            model_paths[name] = future.result()
+            print(name, 'model saved to', model_paths[name])
+    return model_paths
+
+def compare_joint_to_single_models(joint_df: np.ndarray, validation_split: float = 0.1) -> 'DataFrame':
+    """Benchmark the joint model against the three single variable models 
+    on the validation tail of the training data. Returns the mean
+    reconstruction error per variable for both variants.
     """
-    aurora_secret = get_aurora_secret()
+    import pandas as pd
+    from keras.models import load_model
+    split = int(len(joint_df) * (1 - validation_split))
+    validation = joint_df[split:]
+    model_joint = load_model(os.path.join(MODEL_DIR, 'joint_model.h5'))
+    joint_predictions = model_joint.predict(validation)
+    joint_mse = np.mean(np.power(validation - joint_predictions, 2), axis=(0, 1))
+    single_mse = []
+    for channel, name in enumerate(['soil', 'light', 'air']):
+        model = load_model(os.path.join(MODEL_DIR, f'{name}_model.h5'))
+        channel_validation = validation[:, :, channel:channel + 1]
+        predictions = model.predict(channel_validation)
+        single_mse.append(np.mean(np.power(channel_validation - predictions, 2)))
+    return pd.DataFrame({'single_mse': single_mse, 'joint_mse': joint_mse},
+                        index=['soil', 'light', 'air'])
+
+def main(joint: bool = False):
+    """Creates training data and trains the Keras neural network models in 
+    parallel, streaming the training windows from disk, then saves the 
+    trained models to a local directory. Interrupted training resumes
+    from the last checkpoint when rerun.
+    If joint is True, trains the single multi-channel model instead and 
+    compares it against the previously saved single variable models.
+    """
+    aurora_secret = get_secret(AURORA_SECRET)
     conn = create_engine(f"postgresql+psycopg2://{aurora_secret['username']}:{aurora_secret['password']}@{aurora_secret['host']}/{aurora_secret['engine']}")
     soil_df, light_df, air_df = create_training_dataframes(conn)
-    model_soil, model_light, model_air = create_models()
-    train_models(soil_df, light_df, air_df, model_soil, model_light, model_air)
+    if joint:
+        joint_df = create_joint_training_array(soil_df, light_df, air_df)
+        train_models(save_training_windows({'joint': joint_df}))
+        print(compare_joint_to_single_models(joint_df))
+    else:
+        window_paths = save_training_windows({'soil': soil_df,
+                                            'light': light_df,
+                                            'air': air_df})
+        train_models(window_paths)
 
 
 if __name__ == '__main__':
-    main()
-
-
-
-
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--joint', action='store_true',
+                        help='train the joint soil/light/air model')
+    args = parser.parse_args()
+    main(args.joint)
@@ -1,18 +1,203 @@
 #! /usr/bin/env python3
 
+import os
+import threading
+import time
+
 import psycopg2
+from psycopg2.pool import PoolError
+
+# Connections per process in pooled mode
+POOL_SIZE = int(os.environ.get('GROW_DB_POOL_SIZE', 5))
+# Seconds before a pooled connection is closed and replaced
+POOL_MAX_LIFETIME = int(os.environ.get('GROW_DB_POOL_MAX_LIFETIME', 1800))
+# Seconds a pooled connection may sit idle before it is checked with SELECT 1
+POOL_PING_AFTER = int(os.environ.get('GROW_DB_POOL_PING_AFTER', 30))
+# Seconds to wait for a free pooled connection before raising PoolError
+POOL_TIMEOUT = int(os.environ.get('GROW_DB_POOL_TIMEOUT', 30))
+# Postgres NOTIFY channel of sensor status changes & new latest readings,
+# sent by the ETL scripts and streamed to browsers by the back end
+UPDATES_CHANNEL = 'grow_updates'
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections for one set of
+    credentials. Connections are opened when first needed and kept
+    for reuse. Callers wait up to timeout seconds for a free
+    connection when all connections are in use.
+    """
+
+    def __init__(self, config: dict, size: int, max_lifetime: int,
+                timeout: int) -> None:
+        self.config = config
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        # (connection, returned at) waiting for reuse, most recent last
+        self.idle = []
+        # Creation time of every open connection, removed when it is closed
+        self.created = dict()
+        self.lock = threading.Lock()
+        self.metrics = {'checkouts': 0, 'connects': 0, 'wait_seconds_total': 0.0,
+                        'wait_seconds_max': 0.0, 'recycled': 0,
+                        'failed_health_checks': 0, 'timeouts': 0}
+
+    def getconn(self) -> 'connection':
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.metrics['timeouts'] += 1
+            raise PoolError(f'Connection pool exhausted, all {self.size} connections '
+                            f'in use for {self.timeout}s')
+        waited = time.monotonic() - start
+        try:
+            conn = self._healthy_conn()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.metrics['checkouts'] += 1
+            self.metrics['wait_seconds_total'] += waited
+            self.metrics['wait_seconds_max'] = max(self.metrics['wait_seconds_max'], waited)
+        return conn
+
+    def _healthy_conn(self) -> 'connection':
+        """Reuse an idle connection, replacing ones that are too old
+        or no longer respond, or open a new one.
+        """
+        while True:
+            with self.lock:
+                conn, returned = self.idle.pop() if self.idle else (None, None)
+            if conn is None:
+                conn = psycopg2.connect(**self.config)
+                with self.lock:
+                    self.created[id(conn)] = time.monotonic()
+                    self.metrics['connects'] += 1
+                return conn
+            now = time.monotonic()
+            if now - self.created[id(conn)] > self.max_lifetime:
+                self._discard(conn, 'recycled')
+                continue
+            if now - returned > POOL_PING_AFTER:
+                # Only connections idle for a while may have been dropped
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn, 'failed_health_checks')
+                    continue
+            return conn
+
+    def _forget(self, conn) -> None:
+        # A new connection may get the id of a closed one
+        with self.lock:
+            self.created.pop(id(conn), None)
+
+    def _discard(self, conn, reason: str) -> None:
+        self._forget(conn)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.lock:
+            self.metrics[reason] += 1
+
+    def putconn(self, conn) -> None:
+        try:
+            if conn.closed:
+                self._forget(conn)
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+        finally:
+            self.slots.release()
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def get_pool(config: dict) -> ConnectionPool:
+    """Return the process-wide pool for these credentials"""
+    key = tuple(sorted(config.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(config, POOL_SIZE, POOL_MAX_LIFETIME, POOL_TIMEOUT)
+        return _pools[key]
+
+def pool_metrics() -> list:
+    """Return checkout, wait-time, timeout and recycling metrics of every pool"""
+    with _pools_lock:
+        return [dict(db_pool.metrics, dbname=dict(key).get('dbname'))
+                for key, db_pool in _pools.items()]
+
+def create_data_version_table(cursor) -> None:
+    """Create single row table holding the version of the data 
+    served by the Flask apps. ETL scripts bump it after every
+    change so the apps know when to drop their caches.
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS data_version(
+                    id integer PRIMARY KEY,
+                    version bigint NOT NULL,
+                    updated_at timestamp NOT NULL
+                    )""")
+
+def bump_data_version(cursor) -> None:
+    """Increment the data version after an ETL step commits new data"""
+    create_data_version_table(cursor)
+    cursor.execute("""INSERT INTO data_version VALUES (1, 1, NOW())
+                    ON CONFLICT (id) DO UPDATE
+                    SET version = data_version.version + 1,
+                        updated_at = NOW()""")
+
+def fetch_data_version(cursor) -> tuple:
+    """Return the current (version, updated_at) of the data, (0, None)
+    until an ETL script first bumps it. The table is only created by
+    bump_data_version, so reading the version never runs DDL.
+    """
+    cursor.execute("""SELECT to_regclass('data_version') IS NOT NULL""")
+    if not cursor.fetchone()[0]:
+        return (0, None)
+    cursor.execute("""SELECT version, updated_at FROM data_version WHERE id = 1""")
+    return cursor.fetchone() or (0, None)
 
 class UseDatabase:
 
-    def __init__(self, config: dict) -> None:
+    def __init__(self, config: dict, pooled: bool = False) -> None:
         self.configuration = config
+        self.pooled = pooled
 
     def __enter__(self) -> 'cursor':
-        self.conn = psycopg2.connect(**self.configuration)
-        self.cursor = self.conn.cursor()
+        if self.pooled:
+            self.conn = get_pool(self.configuration).getconn()
+        else:
+            self.conn = psycopg2.connect(**self.configuration)
+        try:
+            self.cursor = self.conn.cursor()
+        except Exception:
+            self._release(broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_trace) -> None:
-        self.conn.commit()
-        self.cursor.close()
-        self.conn.close()
\ No newline at end of file
+        broken = True
+        try:
+            if not self.pooled:
+                self.conn.commit()
+            elif not self.conn.closed and exc_type is None:
+                self.conn.commit()
+            elif not self.conn.closed:
+                # Don't hand a failed transaction back to the pool
+                self.conn.rollback()
+            self.cursor.close()
+            broken = False
+        finally:
+            self._release(broken)
+
+    def _release(self, broken: bool) -> None:
+        """Close the connection, or return it to the pool. A connection
+        that failed to commit or roll back is closed, not reused.
+        """
+        if broken or not self.pooled:
+            self.conn.close()
+        if self.pooled:
+            get_pool(self.configuration).putconn(self.conn)
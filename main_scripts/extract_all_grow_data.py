@@ -6,11 +6,10 @@ import json
 from typing import List, Tuple
 
 import requests
-import pandas as pd
 import psycopg2
 from psycopg2 import sql 
 
-from use_postgres import UseDatabase
+from use_postgres import UPDATES_CHANNEL, UseDatabase
 
 def grab_grow_sensor_uptimes() -> List:
     """Fetch and return all GROW sensor IDs and their start and end datetimes"""
@@ -39,7 +38,7 @@ def check_most_recent_grow_data(aurora_creds: dict, sensor_id: str,
     that add up to the delta interval. This is done because the GROW API
     only allows query ranges to be 10 days maximum.
     """
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         table_name = f"grow_data_{sensor_id}"
         try:
             # Get the most recent sensor recording datetime
@@ -152,6 +151,8 @@ def convert_lists_to_dataframe(sensor_id: str, soil_moisture: List,
     """Convert GROW data lists to 1 DataFrame. 
     Save DataFrame to local file.
     """
+    # pandas is only imported when a sensor has new data
+    import pandas as pd
     df = pd.DataFrame(soil_moisture, columns=['datetime', 'soil_moisture'])
     df['light'] = [x[1] for x in light]
     df['air_temperature'] = [x[1] for x in air_temperature]
@@ -161,7 +162,7 @@ def convert_lists_to_dataframe(sensor_id: str, soil_moisture: List,
 
 def insert_df_to_aurora(aurora_creds: dict, sensor_id: str) -> None:
     """Create table in AWS Aurora and insert GROW data"""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         table_name = f"grow_data_{sensor_id}"
         sql_create = sql.SQL("""CREATE TABLE IF NOT EXISTS {}(
                         sensor_id varchar(8),
@@ -172,9 +173,185 @@ def insert_df_to_aurora(aurora_creds: dict, sensor_id: str) -> None:
                         battery_level numeric
                         )""").format(sql.Identifier(table_name))
         cursor.execute(sql_create)
+        previous_watermark = fetch_watermark(cursor, table_name)
         with open(f'temp_csvs/grow_data_{sensor_id}.csv') as csv:
             next(csv)
             cursor.copy_from(csv, table_name, columns=('datetime','soil_moisture','light','air_temperature','battery_level','sensor_id'), sep=',')
+        update_watermark(cursor, table_name)
+        update_latest_reading(cursor, sensor_id)
+        update_rollups(cursor, sensor_id, previous_watermark)
+
+def create_watermark_table(cursor) -> None:
+    """Create table holding the most recent observation datetime
+    per GROW table, so later pipeline steps can join against it
+    instead of scanning every GROW table for MAX(datetime).
+    """
+    sql_create = """CREATE TABLE IF NOT EXISTS grow_watermarks(
+                    grow_table varchar(18) PRIMARY KEY,
+                    last_datetime timestamp
+                    )"""
+    cursor.execute(sql_create)
+
+def update_watermark(cursor, table_name: str) -> None:
+    """Upsert the most recent observation datetime of a GROW table"""
+    create_watermark_table(cursor)
+    sql_upsert = sql.SQL("""INSERT INTO grow_watermarks (grow_table, last_datetime)
+                            SELECT {}, MAX(datetime) FROM {}
+                            ON CONFLICT (grow_table) DO UPDATE
+                            SET last_datetime = EXCLUDED.last_datetime""").format(
+                                sql.Literal(table_name),
+                                sql.Identifier(table_name))
+    cursor.execute(sql_upsert)
+
+def fetch_watermark(cursor, table_name: str) -> datetime.datetime:
+    """Return the most recent observation datetime of a GROW table,
+    None if nothing has been stored yet.
+    """
+    create_watermark_table(cursor)
+    cursor.execute("""SELECT last_datetime FROM grow_watermarks
+                    WHERE grow_table = %s""", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def create_latest_reading_table(cursor) -> None:
+    """Create table holding the most recent reading of every GROW sensor"""
+    sql_create = """CREATE TABLE IF NOT EXISTS sensor_latest_reading(
+                    sensor_id varchar(8) PRIMARY KEY,
+                    battery_level numeric,
+                    soil_moisture numeric,
+                    light numeric,
+                    air_temperature numeric,
+                    datetime timestamp
+                    )"""
+    cursor.execute(sql_create)
+
+def update_latest_reading(cursor, sensor_id: str) -> None:
+    """Upsert the most recent reading of a GROW sensor and send it on
+    the UPDATES_CHANNEL notification channel
+    """
+    create_latest_reading_table(cursor)
+    sql_upsert = sql.SQL("""INSERT INTO sensor_latest_reading
+                            SELECT {}, battery_level, soil_moisture, 
+                                light, air_temperature, datetime
+                            FROM {}
+                            ORDER BY datetime DESC
+                            LIMIT 1
+                            ON CONFLICT (sensor_id) DO UPDATE
+                            SET battery_level = EXCLUDED.battery_level,
+                                soil_moisture = EXCLUDED.soil_moisture,
+                                light = EXCLUDED.light,
+                                air_temperature = EXCLUDED.air_temperature,
+                                datetime = EXCLUDED.datetime""").format(
+                                sql.Literal(sensor_id),
+                                sql.Identifier(f'grow_data_{sensor_id}'))
+    cursor.execute(sql_upsert)
+    # Notifications are delivered to the back end's listeners on commit
+    sql_notify = """SELECT pg_notify(%s, json_build_object(
+                        'type', 'latest_reading',
+                        'sensor_id', sensor_id,
+                        'battery_level', battery_level,
+                        'soil_moisture', soil_moisture,
+                        'light', light,
+                        'air_temperature', air_temperature,
+                        'datetime', datetime)::text)
+                    FROM sensor_latest_reading
+                    WHERE sensor_id = %s"""
+    cursor.execute(sql_notify, (UPDATES_CHANNEL, sensor_id))
+
+# Rollup table name and the date_trunc field of its buckets
+ROLLUPS = {'grow_rollup_hourly': 'hour', 'grow_rollup_daily': 'day'}
+# GROW variables summarised in the rollup tables
+ROLLUP_VARIABLES = ['light', 'air_temperature', 'soil_moisture']
+
+def create_rollup_tables(cursor) -> None:
+    """Create tables holding hourly & daily count, min, mean & max
+    of every GROW variable per sensor, so long time ranges can be
+    charted without reading every 15 minute reading.
+    """
+    columns = sql.SQL(', ').join(
+        sql.SQL('{} numeric').format(sql.Identifier(f'{variable}_{stat}'))
+        for variable in ROLLUP_VARIABLES for stat in ['min', 'mean', 'max'])
+    for rollup_table in ROLLUPS:
+        sql_create = sql.SQL("""CREATE TABLE IF NOT EXISTS {}(
+                                sensor_id varchar(8),
+                                bucket timestamp,
+                                readings integer,
+                                {},
+                                PRIMARY KEY (sensor_id, bucket)
+                                )""").format(sql.Identifier(rollup_table), columns)
+        cursor.execute(sql_create)
+
+def update_rollups(cursor, sensor_id: str, since: datetime.datetime = None) -> None:
+    """Recompute the hourly & daily rollups of a GROW sensor from the
+    bucket holding since onwards, all buckets if since is None. The
+    bucket of since is recomputed as it may have been partly filled.
+    """
+    create_rollup_tables(cursor)
+    stat_columns = [sql.Identifier(f'{variable}_{stat}')
+                    for variable in ROLLUP_VARIABLES for stat in ['min', 'mean', 'max']]
+    stat_selects = sql.SQL(', ').join(
+        sql.SQL('{}({})').format(sql.SQL(function), sql.Identifier(variable))
+        for variable in ROLLUP_VARIABLES for function in ['MIN', 'AVG', 'MAX'])
+    stat_updates = sql.SQL(', ').join(
+        sql.SQL('{0} = EXCLUDED.{0}').format(column) for column in stat_columns)
+    for rollup_table, field in ROLLUPS.items():
+        if since is None:
+            where = sql.SQL('')
+        else:
+            where = sql.SQL('WHERE datetime >= date_trunc({}, {}::timestamp)').format(
+                sql.Literal(field), sql.Literal(since))
+        sql_upsert = sql.SQL("""INSERT INTO {} (sensor_id, bucket, readings, {})
+                                SELECT {}, date_trunc({}, datetime), COUNT(*), {}
+                                FROM {}
+                                {}
+                                GROUP BY 2
+                                ON CONFLICT (sensor_id, bucket) DO UPDATE
+                                SET readings = EXCLUDED.readings, {}""").format(
+                                    sql.Identifier(rollup_table),
+                                    sql.SQL(', ').join(stat_columns),
+                                    sql.Literal(sensor_id),
+                                    sql.Literal(field),
+                                    stat_selects,
+                                    sql.Identifier(f'grow_data_{sensor_id}'),
+                                    where,
+                                    stat_updates)
+        cursor.execute(sql_upsert)
+
+def backfill_rollups(aurora_creds: dict) -> None:
+    """Build rollups of GROW tables loaded before the rollup tables
+    existed. After the first run no tables are missing.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        create_rollup_tables(cursor)
+        sql_missing = """SELECT table_name 
+                        FROM information_schema.tables t
+                        WHERE table_name LIKE 'grow_data_%%'
+                        AND NOT EXISTS 
+                            (SELECT 1 FROM grow_rollup_hourly r
+                            WHERE r.sensor_id = SUBSTRING(t.table_name, 11, 8));"""
+        cursor.execute(sql_missing)
+        for i in cursor.fetchall():
+            update_rollups(cursor, i[0][len('grow_data_'):])
+
+def backfill_watermarks(aurora_creds: dict) -> None:
+    """Add watermarks and latest readings for GROW tables loaded
+    before grow_watermarks and sensor_latest_reading existed.
+    After the first run no tables are missing.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        create_watermark_table(cursor)
+        create_latest_reading_table(cursor)
+        sql_missing = """SELECT table_name 
+                        FROM information_schema.tables 
+                        WHERE table_name LIKE 'grow_data_%%'
+                        AND (table_name NOT IN 
+                                (SELECT grow_table FROM grow_watermarks)
+                            OR SUBSTRING(table_name, 11, 8) NOT IN
+                                (SELECT sensor_id FROM sensor_latest_reading));"""
+        cursor.execute(sql_missing)
+        for i in cursor.fetchall():
+            update_watermark(cursor, i[0])
+            update_latest_reading(cursor, i[0][len('grow_data_'):])
 
 def main(aurora_host: str, db_name: str, aurora_username: str, aurora_password: str):
     """Extracts all GROW data from all GROW sensors and inserts that data
@@ -187,6 +364,8 @@ def main(aurora_host: str, db_name: str, aurora_username: str, aurora_password:
         'user': aurora_username,
         'password': aurora_password
     }
+    backfill_watermarks(aurora_creds)
+    backfill_rollups(aurora_creds)
     sensor_uptime_list = grab_grow_sensor_uptimes()
     for i in sensor_uptime_list:
         sensor_id, sensor_start_end_intervals = check_most_recent_grow_data(aurora_creds, i[0], i[1], i[2])
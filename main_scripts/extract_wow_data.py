@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+from typing import List
+
+import requests
+from psycopg2.extras import execute_values
+
+from use_postgres import UseDatabase
+
+# Days of observations fetched for a WOW site that has not been stored yet
+BACKFILL_DAYS = 30
+# Days of observations requested from the WOW API per call
+INTERVAL_DAYS = 7
+
+def create_wow_tables(aurora_creds: dict) -> None:
+    """Create tables holding WOW observations and, per WOW site, the
+    most recent stored observation datetime and the datetime the
+    stored observations are complete from.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        sql_create = """CREATE TABLE IF NOT EXISTS wow_observations(
+                        site_id varchar(36),
+                        datetime timestamp,
+                        air_temp numeric,
+                        rainfall numeric,
+                        PRIMARY KEY (site_id, datetime)
+                        );
+                        CREATE TABLE IF NOT EXISTS wow_watermarks(
+                        site_id varchar(36) PRIMARY KEY,
+                        last_datetime timestamp,
+                        backfilled_from timestamp
+                        );
+                        ALTER TABLE wow_watermarks
+                        ADD COLUMN IF NOT EXISTS backfilled_from timestamp;"""
+        cursor.execute(sql_create)
+        # Sites stored before backfilled_from was recorded are complete
+        # from their first stored observation
+        cursor.execute("""UPDATE wow_watermarks w
+                        SET backfilled_from = o.first_datetime
+                        FROM (SELECT site_id, MIN(datetime) AS first_datetime
+                            FROM wow_observations
+                            GROUP BY site_id) o
+                        WHERE o.site_id = w.site_id
+                        AND w.backfilled_from IS NULL;""")
+
+def wow_sites_to_update(aurora_creds: dict) -> List:
+    """Return every WOW site mapped to a GROW sensor with the
+    datetime of its most recent stored observation.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        sql_sites = """SELECT DISTINCT m.site_id, w.last_datetime
+                        FROM grow_to_wow_mapping m
+                        LEFT JOIN wow_watermarks w USING (site_id);"""
+        cursor.execute(sql_sites)
+        return cursor.fetchall()
+
+def calculate_wow_intervals(last_datetime: datetime.datetime,
+                            end_dt: datetime.datetime) -> List:
+    """Split the time since the last stored observation into
+    INTERVAL_DAYS long [start, end] intervals.
+    """
+    if last_datetime is None:
+        start = end_dt - datetime.timedelta(days=BACKFILL_DAYS)
+    else:
+        start = last_datetime + datetime.timedelta(seconds=1)
+    intervals = []
+    while start < end_dt:
+        end = min(start + datetime.timedelta(days=INTERVAL_DAYS), end_dt)
+        intervals.append([start.strftime('%Y-%m-%dT%H:%M:%S'),
+                        end.strftime('%Y-%m-%dT%H:%M:%S')])
+        start = end
+    return intervals
+
+def grab_wow_data(site_id: str, intervals: List, wow_api_key: str) -> List:
+    """Query WOW site for each interval, returning
+    [site_id, datetime, air_temp, rainfall] observations.
+    """
+    header = {'Ocp-Apim-Subscription-Key': wow_api_key}
+    url = 'https://apimgmt.www.wow.metoffice.gov.uk/api/observations/byversion'
+    observations = []
+    for interval in intervals:
+        payload = {'site_id': site_id,
+                'start_time': interval[0], # 2019-05-24T20:00:00
+                'end_time': interval[1]}
+        response = requests.get(url, headers=header, params=payload)
+        json_object = response.json()
+        for i in json_object['Object']:
+            observations.append([site_id,
+                                i['ReportEndDateTime'],
+                                i['DryBulbTemperature_Celsius'],
+                                i['RainfallAmount_Millimetre']])
+    return observations
+
+def insert_wow_data(aurora_creds: dict, site_id: str, observations: List,
+                    backfilled_from: str) -> None:
+    """Insert WOW observations and move the site's watermark forward.
+    backfilled_from, the start of the first interval fetched, is only
+    recorded for a new site.
+    """
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
+        execute_values(cursor, """INSERT INTO wow_observations
+                        (site_id, datetime, air_temp, rainfall)
+                        VALUES %s
+                        ON CONFLICT (site_id, datetime) DO NOTHING""", observations)
+        cursor.execute("""INSERT INTO wow_watermarks (site_id, last_datetime, backfilled_from)
+                        SELECT site_id, MAX(datetime), %s
+                        FROM wow_observations
+                        WHERE site_id = %s
+                        GROUP BY site_id
+                        ON CONFLICT (site_id) DO UPDATE
+                        SET last_datetime = EXCLUDED.last_datetime,
+                        backfilled_from = COALESCE(wow_watermarks.backfilled_from,
+                                                    EXCLUDED.backfilled_from)""",
+                        (backfilled_from, site_id))
+
+def main(aurora_host: str, db_name: str, aurora_username: str,
+        aurora_password: str, wow_api_key: str):
+    """Copies new WOW observations of every WOW site mapped to a
+    GROW sensor to the Aurora 'wow_observations' table, starting
+    from each site's last stored observation. New sites are backfilled
+    BACKFILL_DAYS, the Flask back end fetches older observations from
+    the WOW API.
+    """
+    aurora_creds = {
+        'host': aurora_host,
+        'port': 5432,
+        'dbname': db_name,
+        'user': aurora_username,
+        'password': aurora_password
+    }
+    create_wow_tables(aurora_creds)
+    end_dt = datetime.datetime.utcnow().replace(microsecond=0)
+    for site_id, last_datetime in wow_sites_to_update(aurora_creds):
+        intervals = calculate_wow_intervals(last_datetime, end_dt)
+        if intervals == []:
+            continue
+        observations = grab_wow_data(site_id, intervals, wow_api_key)
+        if observations == []:
+            continue
+        insert_wow_data(aurora_creds, site_id, observations, intervals[0][0])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('aurora_host')
+    parser.add_argument('db_name')
+    parser.add_argument('aurora_username')
+    parser.add_argument('aurora_password')
+    parser.add_argument('wow_api_key')
+    args = parser.parse_args()
+    main(args.aurora_host, args.db_name, args.aurora_username,
+        args.aurora_password, args.wow_api_key)
@@ -28,7 +28,7 @@ def grab_grow_ids() -> List:
 def grow_sensors_to_insert(aurora_creds: dict, grow_current_sensors: List) -> List:
     """Retrieve GROW sensor IDs of all GROW sensors not currently 
     in 'grow_to_wow_mapping' Aurora table."""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         sql_table_check = """SELECT EXISTS (SELECT 1 FROM pg_tables
                                             WHERE tablename = 'grow_to_wow_mapping');"""
         cursor.execute(sql_table_check)
@@ -89,7 +89,7 @@ def find_nearest_wow(sensors_to_insert: List, wow_site_list: List) -> List:
 
 def insert_to_db(aurora_creds: dict, mappings_and_distance: List) -> None:
     """Insert the GROW/WOW sensor/site mappings to AWS Aurora DB"""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         sql_create = """CREATE TABLE IF NOT EXISTS grow_to_wow_mapping(
                         sensor_id varchar(8),
                         grow_lat numeric, 
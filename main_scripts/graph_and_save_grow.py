@@ -5,9 +5,7 @@ import datetime
 import os
 
 import requests
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from psycopg2 import sql
 from typing import List
 
@@ -66,7 +64,7 @@ def calculate_grow_time_intervals(sensor_uptimes: List, sensor_id: str) -> List:
 
 def grab_data(aurora_creds: dict, sensor_id: str, start_end_interval: List) -> List:
     """Grab GROW data from GROW table for specific start/end interval."""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         table_name = f'grow_data_{sensor_id}'
         cursor.execute(sql.SQL("""SELECT soil_moisture, light, air_temperature, datetime
                         FROM {}
@@ -82,6 +80,9 @@ def grab_data(aurora_creds: dict, sensor_id: str, start_end_interval: List) -> L
 
 def create_graph(sensor_id: str, data: List, start_end_interval: List) -> 'Matplotlib Graph':
     """Graph the three extracted GROW attributes and save graph to file."""
+    # matplotlib & pandas are only imported when there is data to graph
+    import matplotlib.pyplot as plt
+    import pandas as pd
     datetimes = [pd.to_datetime(x[3]) for x in data]
     y1 = np.array([x[0] for x in data])
     y2 = np.array([x[1] for x in data])
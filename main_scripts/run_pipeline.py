@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+# Stage: (script, stages it waits for). Every stage starts as soon as
+# all of its dependencies have succeeded, independent stages run in parallel
+STAGES = {
+    'store_sensor_info': ('store_sensor_info.py', []),
+    'find_nearest_wow_live': ('find_nearest_wow_live.py', []),
+    'extract_all_grow_data': ('extract_all_grow_data.py', []),
+    'extract_wow_data': ('extract_wow_data.py', ['find_nearest_wow_live']),
+    'detect_anomalies': ('detect_anomalies.py', ['store_sensor_info', 'extract_all_grow_data'])
+}
+# Scripts are looked for next to this one (ie: all copied to
+# /home/ec2-user) and then in the repository layout
+SCRIPT_DIRS = [os.path.dirname(os.path.abspath(__file__)),
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'machine_learning')]
+PIPELINE_LOCK = 'grow_pipeline.lock'
+
+def find_script(script: str) -> str:
+    for directory in SCRIPT_DIRS:
+        path = os.path.abspath(os.path.join(directory, script))
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f'{script} not found in {SCRIPT_DIRS}')
+
+def stage_arguments(args: argparse.Namespace) -> Dict[str, List[str]]:
+    """Command line arguments each stage's script parses"""
+    aurora = [args.aurora_host, args.db_name, args.aurora_username, args.aurora_password]
+    detect = []
+    if args.joint:
+        detect.append('--joint')
+    if args.service_url:
+        detect.extend(['--service', args.service_url])
+    return {
+        'store_sensor_info': aurora + [args.gcloud_api_key],
+        'find_nearest_wow_live': aurora,
+        'extract_all_grow_data': aurora,
+        'extract_wow_data': aurora + [args.wow_api_key],
+        'detect_anomalies': detect
+    }
+
+def acquire_lock(lock_dir: str, name: str):
+    """Return an open, exclusively flock-ed lock file, None if another
+    process holds it. The lock is released when the file is closed or
+    the process exits, so a crashed run never leaves a stale lock.
+    """
+    lock_file = open(os.path.join(lock_dir, name), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+def run_stage(name: str, arguments: List[str]) -> dict:
+    """Run a stage's script in its own directory (for its relative
+    model & JSON files) and return its timing.
+    """
+    started = datetime.datetime.now()
+    start = time.monotonic()
+    try:
+        script = find_script(STAGES[name][0])
+        print(f'{started:%H:%M:%S} start {name}', flush=True)
+        result = subprocess.run([sys.executable, script] + arguments,
+                                cwd=os.path.dirname(script))
+        status = 'ok' if result.returncode == 0 else f'failed ({result.returncode})'
+    except OSError as error:
+        print(f'{name} error: ', error, flush=True)
+        status = 'failed'
+    return {'started': started, 'seconds': time.monotonic() - start, 'status': status}
+
+def run_pipeline(arguments: Dict[str, List[str]]) -> Dict[str, dict]:
+    """Run every stage once its dependencies succeed. Stages depending
+    on a failed stage are skipped, the others still run.
+    """
+    report = dict()
+    pending = dict(STAGES)
+    running = dict()
+    with ThreadPoolExecutor(max_workers=len(STAGES)) as executor:
+        while pending or running:
+            for name, (script, dependencies) in list(pending.items()):
+                if any(report.get(x, {}).get('status') not in (None, 'ok') for x in dependencies):
+                    report[name] = {'started': None, 'seconds': 0.0, 'status': 'skipped'}
+                    del pending[name]
+                elif all(report.get(x, {}).get('status') == 'ok' for x in dependencies):
+                    running[executor.submit(run_stage, name, arguments[name])] = name
+                    del pending[name]
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                report[name] = future.result()
+                print(f'{datetime.datetime.now():%H:%M:%S} {report[name]["status"]} {name}',
+                        flush=True)
+    return report
+
+def print_report(report: Dict[str, dict], total_seconds: float) -> None:
+    print(f'{"stage":<24}{"started":<11}{"seconds":>10}  status')
+    for name in STAGES:
+        timing = report[name]
+        started = f'{timing["started"]:%H:%M:%S}' if timing['started'] else '-'
+        print(f'{name:<24}{started:<11}{timing["seconds"]:>10.1f}  {timing["status"]}')
+    print(f'{"total":<35}{total_seconds:>10.1f}')
+
+def main(args: argparse.Namespace) -> int:
+    """Runs the ETL & anomaly detection scripts as one pipeline, each
+    script starting as soon as the scripts it needs have finished,
+    instead of at fixed Cron times. A run does not start while the
+    previous one holds the pipeline lock. Returns 1 if any stage did
+    not succeed, so Cron mails the report.
+    """
+    pipeline_lock = acquire_lock(args.lock_dir, PIPELINE_LOCK)
+    if pipeline_lock is None:
+        print('Previous pipeline run still in progress, not starting')
+        return 1
+    start = time.monotonic()
+    try:
+        report = run_pipeline(stage_arguments(args))
+    finally:
+        pipeline_lock.close()
+    print_report(report, time.monotonic() - start)
+    return 0 if all(x['status'] == 'ok' for x in report.values()) else 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('aurora_host')
+    parser.add_argument('db_name')
+    parser.add_argument('aurora_username')
+    parser.add_argument('aurora_password')
+    parser.add_argument('gcloud_api_key')
+    parser.add_argument('wow_api_key')
+    parser.add_argument('--joint', action='store_true',
+                        help='passed on to detect_anomalies.py')
+    parser.add_argument('--service', dest='service_url', default=None,
+                        help='passed on to detect_anomalies.py')
+    parser.add_argument('--lock-dir', dest='lock_dir', default='/tmp',
+                        help='directory of the pipeline lock file')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -9,7 +9,7 @@ from typing import List
 
 import requests
 
-from use_postgres import UseDatabase
+from use_postgres import UseDatabase, bump_data_version
 
 def grab_grow_sensors() -> List:
     """Grabs all GROW sensor IDs, last upload date, days active"""
@@ -43,7 +43,7 @@ def filter_for_new_sensor_updates(aurora_creds: dict, new_sensor_list: List) ->
     """Compare sensor info to Aurora table to see if the individual sensor 
     info is already in the table. If not present, keep the sensor info for further 
     processing and eventual insert into Aurora table"""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         sql_check = """SELECT EXISTS (SELECT 1 FROM pg_tables
                                         WHERE tablename = 'all_sensor_info');"""
         cursor.execute(sql_check)
@@ -109,7 +109,7 @@ def get_address(latlng: str, api_key: str) -> List:
 
 def insert_to_aurora(aurora_creds: dict, sensor_list: List, stored_sensor_ids: List) -> None:
     """Insert sensor list details to AWS Aurora DB"""
-    with UseDatabase(aurora_creds) as cursor:
+    with UseDatabase(aurora_creds, pooled=True) as cursor:
         sql_create = """CREATE TABLE IF NOT EXISTS all_sensor_info(
                         sensor_id varchar(8),
                         days_active integer, 
@@ -120,6 +120,7 @@ def insert_to_aurora(aurora_creds: dict, sensor_list: List, stored_sensor_ids: L
                         address varchar(140), 
                         owner_id varchar(36));"""
         cursor.execute(sql_create)
+        create_address_search_index(cursor)
         for i in sensor_list:
             if i[0] in stored_sensor_ids:
                 cursor.execute("""UPDATE all_sensor_info
@@ -132,6 +133,17 @@ def insert_to_aurora(aurora_creds: dict, sensor_list: List, stored_sensor_ids: L
                 cursor.execute("""INSERT INTO all_sensor_info
                             VALUES(%s, %s, %s, %s, %s, %s, %s, %s)""",
                             (i[0], i[1], i[2], i[3], i[4], i[5], i[6], i[7]))
+        bump_data_version(cursor)
+
+def create_address_search_index(cursor) -> None:
+    """Create trigram index on sensor addresses, so the front end's
+    address autocomplete can match any part of an address by index
+    instead of scanning 'all_sensor_info' on every keystroke.
+    """
+    sql_create = """CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    CREATE INDEX IF NOT EXISTS all_sensor_info_address_trgm_idx
+                    ON all_sensor_info USING gin (address gin_trgm_ops);"""
+    cursor.execute(sql_create)
 
 def main(aurora_host: str, db_name: str, aurora_username: str, 
         aurora_password: str, gcloud_api_key: str):